@@ -23,14 +23,32 @@ import os
 import re
 import time
 import sys
+import stat
+import shutil
+import json
+import math
+import hashlib
+import html
+import queue
 import logging
-from dataclasses import dataclass
+import argparse
+import threading
+import statistics
+import weakref
+import itertools
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+from urllib.parse import parse_qsl, unquote, urlencode, urljoin, urlparse
 
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from playwright.sync_api import sync_playwright, TimeoutError as PWTimeout
 
 
@@ -66,14 +84,47 @@ BASE_DOWNLOAD_DIR = os.getenv("BASE_DOWNLOAD_DIR", r"C:\FinanceDownloads").strip
 
 PULSEEM_AUTH_MODE = os.getenv("PULSEEM_AUTH_MODE", "header").strip().lower()
 PULSEEM_APIKEY_HEADER = os.getenv("PULSEEM_APIKEY_HEADER", "ApiKey").strip()
+PULSEEM_RETRIES = int(os.getenv("PULSEEM_RETRIES", "3"))
+PULSEEM_RETRY_BACKOFF = float(os.getenv("PULSEEM_RETRY_BACKOFF", "0.3"))
+# Preflight only verifies connectivity/auth ("no data" is OK), so a tiny window is enough
+PREFLIGHT_LOOKBACK_SECONDS = int(os.getenv("PREFLIGHT_LOOKBACK_SECONDS", "60"))
+PREFLIGHT_CACHE_TTL_SECONDS = int(os.getenv("PREFLIGHT_CACHE_TTL_SECONDS", "3600"))
+# Persisted "newest SMS seen" per virtual number: used as the checkpoint as-is only if it covers up to
+# (almost) now; a gap up to SMS_CURSOR_MAX_AGE_SECONDS is closed by querying just [covered_until, now]
+SMS_CURSOR_FRESH_SECONDS = float(os.getenv("SMS_CURSOR_FRESH_SECONDS", "5"))
+SMS_CURSOR_MAX_AGE_SECONDS = int(os.getenv("SMS_CURSOR_MAX_AGE_SECONDS", "3600"))
 
 OTP_LOOKBACK_SECONDS = int(os.getenv("OTP_LOOKBACK_SECONDS", "240"))
 OTP_MAX_WAIT_SECONDS = int(os.getenv("OTP_MAX_WAIT_SECONDS", "90"))
 OTP_POLL_SECONDS = float(os.getenv("OTP_POLL_SECONDS", "2"))
+# No longer slept: only the prior for "when does the SMS usually arrive" until real history exists
 OTP_INITIAL_DELAY_SECONDS = int(os.getenv("OTP_INITIAL_DELAY_SECONDS", "15"))
+OTP_POLL_MIN_SECONDS = float(os.getenv("OTP_POLL_MIN_SECONDS", "0.5"))
+OTP_POLL_BACKOFF_SECONDS = float(os.getenv("OTP_POLL_BACKOFF_SECONDS", "10"))
+OTP_ARRIVAL_WINDOW_SECONDS = float(os.getenv("OTP_ARRIVAL_WINDOW_SECONDS", "4"))
+OTP_HISTORY_SIZE = int(os.getenv("OTP_HISTORY_SIZE", "20"))
+OTP_WINDOW_SKEW_SECONDS = float(os.getenv("OTP_WINDOW_SKEW_SECONDS", "5"))
+
+# Push delivery: Pulseem (or any relay) POSTs inbound SMS here; polling stays as the fallback
+OTP_WEBHOOK_ENABLED = os.getenv("OTP_WEBHOOK_ENABLED", "false").strip().lower() in ("1", "true", "yes", "y")
+OTP_WEBHOOK_HOST = os.getenv("OTP_WEBHOOK_HOST", "127.0.0.1").strip()
+OTP_WEBHOOK_PORT = int(os.getenv("OTP_WEBHOOK_PORT", "8766"))
+OTP_WEBHOOK_PATH = os.getenv("OTP_WEBHOOK_PATH", "/sms").strip()
+OTP_WEBHOOK_TOKEN = os.getenv("OTP_WEBHOOK_TOKEN", "").strip()
+
 MANUAL_OTP_FALLBACK = os.getenv("MANUAL_OTP_FALLBACK", "true").strip().lower() in ("1", "true", "yes", "y")
 MANUAL_OTP_MAX_WAIT_SECONDS = int(os.getenv("MANUAL_OTP_MAX_WAIT_SECONDS", "240"))
 
+# OTP broker: every source races, first valid code wins, hard overall deadline
+OTP_HTTP_ENABLED = os.getenv("OTP_HTTP_ENABLED", "true").strip().lower() in ("1", "true", "yes", "y")
+OTP_DROP_FILE = os.getenv("OTP_DROP_FILE", "").strip()  # default: <BOT_STATE_DIR>/otp.txt
+OTP_OVERALL_DEADLINE_SECONDS = int(
+    os.getenv(
+        "OTP_OVERALL_DEADLINE_SECONDS",
+        str(max(OTP_MAX_WAIT_SECONDS, MANUAL_OTP_MAX_WAIT_SECONDS) if MANUAL_OTP_FALLBACK else OTP_MAX_WAIT_SECONDS),
+    )
+)
+
 PLAYWRIGHT_HEADLESS = os.getenv("PLAYWRIGHT_HEADLESS", "true").strip().lower() in ("1", "true", "yes", "y")
 
 HAREL_USERNAME = os.getenv("HAREL_USERNAME", "").strip()
@@ -88,6 +139,67 @@ if not PULSEEM_VIRTUAL_NUMBER:
 if not HAREL_USERNAME or not HAREL_PASSWORD:
     log.warning("Missing HAREL_USERNAME/HAREL_PASSWORD in .env")
 
+# ----------------------------
+# Session reuse
+# ----------------------------
+BOT_STATE_DIR = os.getenv("BOT_STATE_DIR", str(Path(__file__).resolve().parent / ".bot_state")).strip()
+REUSE_SESSIONS = os.getenv("REUSE_SESSIONS", "true").strip().lower() in ("1", "true", "yes", "y")
+SESSION_MAX_AGE_SECONDS = int(os.getenv("SESSION_MAX_AGE_SECONDS", "43200"))
+SESSION_VALIDATE_TIMEOUT_MS = int(os.getenv("SESSION_VALIDATE_TIMEOUT_MS", "15000"))
+SESSION_PROBE_TIMEOUT_SECONDS = float(os.getenv("SESSION_PROBE_TIMEOUT_SECONDS", "3"))
+
+# HAR record / replay (--record-har / --replay-har); HAR_PATH / HAR_REPLAY are set by the CLI.
+# The OTP typed during recording is kept next to the archive (<har>.otp): replay must post that exact code.
+HAR_PATH = ""
+HAR_REPLAY = False
+HAR_REPLAY_OTP = os.getenv("HAR_REPLAY_OTP", "").strip()  # override for <har>.otp
+
+# Opt-in: one persistent Chromium profile per site so the portal's static bundles come from disk cache
+BROWSER_PROFILE = os.getenv("BROWSER_PROFILE", "false").strip().lower() in ("1", "true", "yes", "y")
+BROWSER_PROFILE_DIR = os.getenv("BROWSER_PROFILE_DIR", "").strip()  # default: <BOT_STATE_DIR>/profile
+BROWSER_PROFILE_MAX_MB = int(os.getenv("BROWSER_PROFILE_MAX_MB", "500"))
+
+# ----------------------------
+# Keep-alive daemon
+# ----------------------------
+KEEPALIVE_HOST = os.getenv("KEEPALIVE_HOST", "127.0.0.1").strip()
+KEEPALIVE_PORT = int(os.getenv("KEEPALIVE_PORT", "8765"))
+PORTAL_IDLE_TIMEOUT_SECONDS = int(os.getenv("PORTAL_IDLE_TIMEOUT_SECONDS", "900"))
+KEEPALIVE_SAFETY_RATIO = float(os.getenv("KEEPALIVE_SAFETY_RATIO", "0.8"))
+KEEPALIVE_MIN_INTERVAL_SECONDS = int(os.getenv("KEEPALIVE_MIN_INTERVAL_SECONDS", "60"))
+# After this many healthy touches in a row, probe a longer idle timeout again (up to PORTAL_IDLE_TIMEOUT_SECONDS)
+KEEPALIVE_GROW_AFTER_TOUCHES = int(os.getenv("KEEPALIVE_GROW_AFTER_TOUCHES", "12"))
+KEEPALIVE_GROW_FACTOR = float(os.getenv("KEEPALIVE_GROW_FACTOR", "1.25"))
+KEEPALIVE_RUN_TIMEOUT_SECONDS = int(os.getenv("KEEPALIVE_RUN_TIMEOUT_SECONDS", "600"))
+
+# ----------------------------
+# Run time budget
+# ----------------------------
+# Whole run (login + OTP + report + download); 0 = unlimited
+RUN_BUDGET_SECONDS = int(os.getenv("RUN_BUDGET_SECONDS", "900"))
+# Per-step allotments, override with STEP_BUDGETS="login=60,download=120"
+STEP_BUDGETS: Dict[str, float] = {
+    "login": 90,
+    "otp": OTP_OVERALL_DEADLINE_SECONDS + 30,
+    "portal": 60,
+    "report": 90,
+    "grid": 120,
+    "download": 180,
+}
+for _item in os.getenv("STEP_BUDGETS", "").split(","):
+    if "=" in _item:
+        _name, _, _secs = _item.partition("=")
+        STEP_BUDGETS[_name.strip()] = float(_secs)
+
+# Adaptive timeouts: percentile of past successful latencies * safety factor,
+# clamped to [ADAPTIVE_TIMEOUT_FLOOR_MS, the call's fixed timeout]
+ADAPTIVE_TIMEOUTS = os.getenv("ADAPTIVE_TIMEOUTS", "true").strip().lower() in ("1", "true", "yes", "y")
+LATENCY_PERCENTILE = float(os.getenv("LATENCY_PERCENTILE", "95"))
+LATENCY_SAFETY_FACTOR = float(os.getenv("LATENCY_SAFETY_FACTOR", "2.0"))
+LATENCY_MIN_SAMPLES = int(os.getenv("LATENCY_MIN_SAMPLES", "5"))
+LATENCY_HISTORY_SIZE = int(os.getenv("LATENCY_HISTORY_SIZE", "50"))
+ADAPTIVE_TIMEOUT_FLOOR_MS = int(os.getenv("ADAPTIVE_TIMEOUT_FLOOR_MS", "3000"))
+
 # ----------------------------
 # Click / wait tuning
 # ----------------------------
@@ -95,6 +207,59 @@ CLICK_RETRIES = int(os.getenv("CLICK_RETRIES", "5"))
 CLICK_RETRY_BASE_SLEEP = float(os.getenv("CLICK_RETRY_BASE_SLEEP", "0.8"))
 POST_CLICK_SLEEP = float(os.getenv("POST_CLICK_SLEEP", "0.6"))
 SETTLE_SLEEP = float(os.getenv("SETTLE_SLEEP", "0.35"))
+# true = old behaviour (networkidle + SETTLE_SLEEP/POST_CLICK_SLEEP around every click), for debugging only
+LEGACY_PAGE_READY = os.getenv("LEGACY_PAGE_READY", "false").strip().lower() in ("1", "true", "yes", "y")
+OPTIONAL_POSTCONDITION_MS = int(os.getenv("OPTIONAL_POSTCONDITION_MS", "5000"))
+ANY_POSTCONDITION_SLICE_MS = 250  # PostCondition.any_of polls its alternatives in slices this long
+# Close known dialogs in-page (MutationObserver init script) instead of polling from Python per click
+OVERLAY_AUTODISMISS = os.getenv("OVERLAY_AUTODISMISS", "true").strip().lower() in ("1", "true", "yes", "y")
+
+# "Quiet network" = no in-flight request for NETWORK_QUIET_MS, ignoring long-poll/telemetry traffic
+# that keeps SharePoint pages from ever reaching networkidle (comma-separated URL substrings)
+NETWORK_QUIET_MS = int(os.getenv("NETWORK_QUIET_MS", "500"))
+NETWORK_IGNORE_PATTERNS = [
+    p.strip()
+    for p in os.getenv(
+        "NETWORK_IGNORE_PATTERNS",
+        "google-analytics.com,googletagmanager.com,doubleclick.net,clarity.ms,hotjar.com,"
+        "applicationinsights,visualstudio.com,browser.events.data.microsoft.com,"
+        "/_api/contextinfo,/_vti_bin/,signalr,/poll,heartbeat,keepalive,beacon,/collect",
+    ).split(",")
+    if p.strip()
+]
+# true = wait_page_ready uses Playwright's networkidle (counted when it times out) instead of the tracker
+PAGE_READY_NETWORKIDLE = os.getenv("PAGE_READY_NETWORKIDLE", "false").strip().lower() in ("1", "true", "yes", "y")
+# Remember which selector strategy worked per step and try it first next run
+STRATEGY_CACHE_ENABLED = os.getenv("STRATEGY_CACHE_ENABLED", "true").strip().lower() in ("1", "true", "yes", "y")
+# Go straight to the report URL learned from the Favorites link; Favorites UI stays the fallback
+REPORT_DEEP_LINK = os.getenv("REPORT_DEEP_LINK", "true").strip().lower() in ("1", "true", "yes", "y")
+REPORT_DEEP_LINK_TIMEOUT_MS = int(os.getenv("REPORT_DEEP_LINK_TIMEOUT_MS", "15000"))
+# Replay the captured Excel export request over HTTP instead of driving the paid.aspx UI
+EXPORT_REPLAY = os.getenv("EXPORT_REPLAY", "true").strip().lower() in ("1", "true", "yes", "y")
+EXPORT_REPLAY_TIMEOUT_SECONDS = float(os.getenv("EXPORT_REPLAY_TIMEOUT_SECONDS", "60"))
+# Read the results grid from the filter postback's response body; DOM extraction is the fallback
+GRID_FROM_RESPONSE = os.getenv("GRID_FROM_RESPONSE", "true").strip().lower() in ("1", "true", "yes", "y")
+
+# ----------------------------
+# Resource policy (CDP blocked URLs + Blink image setting)
+# ----------------------------
+# The flow needs DOM, scripts, styles and XHR only. Blocking happens inside Chromium (CDP blocked URLs +
+# Blink image setting), so nothing waits on Python and the HTTP cache stays on. An allowlist fragment
+# drops every block pattern it appears in (e.g. "woff" keeps web fonts).
+BLOCK_RESOURCES = os.getenv("BLOCK_RESOURCES", "true").strip().lower() in ("1", "true", "yes", "y")
+BLOCK_RESOURCE_TYPES = {
+    t.strip() for t in os.getenv("BLOCK_RESOURCE_TYPES", "image,font,media").split(",") if t.strip()
+}
+BLOCK_URL_PATTERNS = [
+    p.strip()
+    for p in os.getenv(
+        "BLOCK_URL_PATTERNS",
+        "google-analytics.com,googletagmanager.com,doubleclick.net,clarity.ms,hotjar.com,"
+        "applicationinsights,browser.events.data.microsoft.com,facebook.net",
+    ).split(",")
+    if p.strip()
+]
+BLOCK_ALLOW_PATTERNS = [p.strip() for p in os.getenv("BLOCK_ALLOW_PATTERNS", "").split(",") if p.strip()]
 
 # ----------------------------
 # Pulseem settings
@@ -103,6 +268,271 @@ PULSEEM_URL = "https://api.pulseem.com/api/v1/SmsApi/GetIncomingSmsReport"
 OTP_REGEX = re.compile(r"\b(\d{4,8})\b")
 
 
+# ----------------------------
+# State files (BOT_STATE_DIR)
+# ----------------------------
+_STATE_LOCK = threading.Lock()
+
+
+def state_dir(*parts: str) -> Path:
+    d = Path(BOT_STATE_DIR).joinpath(*parts)
+    d.mkdir(parents=True, exist_ok=True)
+    return d
+
+
+def load_json_state(name: str, default: Any) -> Any:
+    path = state_dir() / name
+    try:
+        with _STATE_LOCK:
+            return json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return default
+    except Exception as e:
+        log.warning(f"[State] Could not read {path}: {e}")
+        return default
+
+
+def save_json_state(name: str, data: Any) -> None:
+    path = state_dir() / name
+    tmp = path.with_name(path.name + ".tmp")
+    try:
+        with _STATE_LOCK:
+            tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+            os.replace(tmp, path)
+    except Exception as e:
+        log.warning(f"[State] Could not write {path}: {e}")
+
+
+# Short side tasks (Pulseem checkpoint etc.) that overlap with browser work
+BACKGROUND_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="bg")
+
+
+# ----------------------------
+# Run budget (global deadline + per-step allotments)
+# ----------------------------
+class BudgetExhausted(RuntimeError):
+    def __init__(self, step: str, spent: float, allowed: float) -> None:
+        super().__init__(f"Time budget exhausted in step '{step}' ({spent:.1f}s spent of {allowed:.0f}s)")
+        self.step = step
+
+
+class RunBudget:
+    """
+    Deadline for a whole run, split into named steps. Each step gets min(its allotment, what is
+    left of the enclosing step / run). Waits ask budget_ms() for their timeout instead of using
+    fixed values, so a broken step fails when its share is gone, attributed to that step.
+    """
+
+    def __init__(self, total_seconds: float, allotments: Optional[Dict[str, float]] = None) -> None:
+        self.started = time.time()
+        self.deadline = self.started + total_seconds if total_seconds > 0 else math.inf
+        self.allotments = dict(STEP_BUDGETS if allotments is None else allotments)
+        self.spent: Dict[str, float] = {}
+        self._stack: List[Tuple[str, float, float]] = []  # (step, started, deadline)
+
+    def _top(self) -> Tuple[str, float, float]:
+        return self._stack[-1] if self._stack else ("run", self.started, self.deadline)
+
+    def remaining(self) -> float:
+        return self._top()[2] - time.time()
+
+    def exhausted_error(self) -> BudgetExhausted:
+        name, started, deadline = self._top()
+        return BudgetExhausted(name, time.time() - started, deadline - started)
+
+    def timeout_ms(self, default_ms: float) -> int:
+        left = self.remaining()
+        if left <= 0:
+            raise self.exhausted_error()
+        return int(max(1, min(default_ms, left * 1000)))
+
+    @contextmanager
+    def step(self, name: str):
+        now = time.time()
+        allot = self.allotments.get(name)
+        deadline = min(self._top()[2], now + allot if allot else math.inf)
+        self._stack.append((name, now, deadline))
+        try:
+            yield self
+        except BudgetExhausted:
+            raise
+        except Exception as e:
+            # a wait cut short by the budget surfaces as a timeout; say which step ran out
+            if time.time() >= deadline:
+                raise self.exhausted_error() from e
+            raise
+        finally:
+            self._stack.pop()
+            self.spent[name] = self.spent.get(name, 0.0) + (time.time() - now)
+
+    @contextmanager
+    def activate(self):
+        prev = current_budget()
+        _BUDGET_LOCAL.budget = self
+        try:
+            yield self
+        finally:
+            _BUDGET_LOCAL.budget = prev
+            self.log_summary()
+
+    def log_summary(self) -> None:
+        parts = " ".join(f"{k}={v:.1f}s" for k, v in self.spent.items())
+        total = "unlimited" if self.deadline == math.inf else f"{self.deadline - self.started:.0f}s"
+        log.info(f"[Budget] {parts or '(no steps)'} | total {time.time() - self.started:.1f}s of {total}")
+
+
+_BUDGET_LOCAL = threading.local()
+
+
+def current_budget() -> Optional[RunBudget]:
+    return getattr(_BUDGET_LOCAL, "budget", None)
+
+
+@contextmanager
+def budget_step(name: str):
+    budget = current_budget()
+    if budget is None:
+        yield None
+        return
+    with budget.step(name):
+        yield budget
+
+
+def budget_ms(default_ms: float) -> int:
+    """default_ms capped by what is left of the current step (raises BudgetExhausted at zero)."""
+    budget = current_budget()
+    return int(default_ms) if budget is None else budget.timeout_ms(default_ms)
+
+
+# ----------------------------
+# Latency history (adaptive timeouts)
+# ----------------------------
+LATENCY_FILE = "latency.json"
+_LATENCY_LOCK = threading.Lock()
+_LATENCY: Optional[Dict[str, List[float]]] = None  # loaded on first use, saved once per run
+
+
+def _latency_samples() -> Dict[str, List[float]]:
+    global _LATENCY
+    if _LATENCY is None:
+        _LATENCY = load_json_state(LATENCY_FILE, {})
+    return _LATENCY
+
+
+def record_latency(key: str, ms: float) -> None:
+    with _LATENCY_LOCK:
+        samples = _latency_samples().setdefault(key, [])
+        samples.append(round(ms, 1))
+        del samples[:-LATENCY_HISTORY_SIZE]
+
+
+def adaptive_timeout_ms(key: str, fixed_ms: int, attempt: int = 1) -> int:
+    """
+    fixed_ms until LATENCY_MIN_SAMPLES successes are known, then pXX * safety factor
+    (doubled per retry attempt), never below the floor nor above fixed_ms.
+    """
+    if not ADAPTIVE_TIMEOUTS:
+        return fixed_ms
+    with _LATENCY_LOCK:
+        ordered = sorted(_latency_samples().get(key) or [])
+    if len(ordered) < LATENCY_MIN_SAMPLES:
+        return fixed_ms
+    idx = min(len(ordered) - 1, max(0, math.ceil(LATENCY_PERCENTILE / 100.0 * len(ordered)) - 1))
+    learned = ordered[idx] * LATENCY_SAFETY_FACTOR * (2 ** (attempt - 1))
+    return int(min(fixed_ms, max(ADAPTIVE_TIMEOUT_FLOOR_MS, learned)))
+
+
+def run_with_adaptive_timeout(key: str, fixed_ms: int, action: Callable[[int], Any]) -> Any:
+    """
+    action(timeout_ms) with the learned timeout for `key`; if that shortened timeout runs out, once more
+    with fixed_ms (a slow day, not a broken page - same rule as the click engine). Records the latency.
+    The action must be safe to repeat and should cap its waits with budget_ms().
+    """
+    learned_ms = adaptive_timeout_ms(key, fixed_ms)
+    started = time.time()
+    try:
+        result = action(learned_ms)
+    except PWTimeout:
+        if learned_ms >= fixed_ms:
+            raise
+        log.warning(f"[Timing] {key} ran out of its learned {learned_ms} ms, retrying with {fixed_ms} ms")
+        started = time.time()
+        result = action(fixed_ms)
+    record_latency(key, (time.time() - started) * 1000)
+    return result
+
+
+def save_latency_history() -> None:
+    with _LATENCY_LOCK:
+        if _LATENCY is None:
+            return
+        data = {k: list(v) for k, v in _LATENCY.items()}
+    save_json_state(LATENCY_FILE, data)
+
+
+# ----------------------------
+# Local HTTP endpoints
+# ----------------------------
+RouteHandler = Callable[[str, Dict[str, Any]], Tuple[int, Dict[str, Any]]]
+
+
+def _read_request_body(handler: BaseHTTPRequestHandler) -> Dict[str, Any]:
+    length = int(handler.headers.get("Content-Length") or 0)
+    raw = handler.rfile.read(length).decode("utf-8", errors="replace") if length else ""
+    if not raw.strip():
+        return {}
+    if "json" in (handler.headers.get("Content-Type") or "").lower():
+        data = json.loads(raw)
+        return data if isinstance(data, dict) else {"data": data}
+    return dict(parse_qsl(raw, keep_blank_values=True))
+
+
+def start_local_http_server(host: str, port: int, routes: Dict[str, RouteHandler], name: str) -> ThreadingHTTPServer:
+    """
+    Tiny JSON endpoint on a daemon thread. Each route gets (method, body/query) and returns (status, payload).
+    """
+
+    class _Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, payload: Dict[str, Any]) -> None:
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _dispatch(self, method: str) -> None:
+            url = urlparse(self.path)
+            route = routes.get(url.path)
+            if route is None:
+                self._reply(404, {"error": f"unknown path {url.path}"})
+                return
+            try:
+                body: Dict[str, Any] = dict(parse_qsl(url.query))
+                if method == "POST":
+                    body.update(_read_request_body(self))
+                status, payload = route(method, body)
+            except Exception as e:
+                log.warning(f"[{name}] {method} {url.path} failed: {e}")
+                status, payload = 500, {"error": str(e)}
+            self._reply(status, payload)
+
+        def do_GET(self) -> None:
+            self._dispatch("GET")
+
+        def do_POST(self) -> None:
+            self._dispatch("POST")
+
+        def log_message(self, format: str, *args: Any) -> None:
+            log.debug(f"[{name}] " + format % args)
+
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=name, daemon=True).start()
+    log.info(f"[{name}] Listening on http://{host}:{server.server_address[1]}")
+    return server
+
+
 # ----------------------------
 # Pulseem helpers
 # ----------------------------
@@ -121,9 +551,22 @@ def format_time(dt_obj: datetime) -> str:
 
 def parse_reply_date(s: str) -> datetime:
     try:
-        return datetime.fromisoformat(s.replace("Z", "+00:00"))
+        dt = datetime.fromisoformat(s.replace("Z", "+00:00"))
     except Exception:
         return datetime.min
+    # keep everything naive-local so it compares with datetime.now()/datetime.min
+    return dt.astimezone().replace(tzinfo=None) if dt.tzinfo else dt
+
+
+def _sms_identity(msg: Dict[str, Any]) -> Tuple[str, ...]:
+    for key in ("Id", "SmsId", "IncomingSmsId", "MessageId"):
+        if msg.get(key):
+            return (str(msg[key]),)
+    return (
+        str(msg.get("ReplyDate", "")),
+        str(msg.get("ReplyText") or ""),
+        str(msg.get("Telephone") or msg.get("Phone") or ""),
+    )
 
 
 @dataclass
@@ -143,24 +586,115 @@ class PulseemAuth:
         return h
 
 
-def get_incoming_sms_report(
-    auth: PulseemAuth,
-    search_txt: Optional[str],
-    start_time: Optional[datetime],
-    end_time: Optional[datetime],
-    timeout_seconds: int = 20,
-) -> Dict[str, Any]:
-    payload: Dict[str, Any] = {}
-    if search_txt:
-        payload["SearchTxt"] = search_txt[:31]
-    if start_time:
-        payload["StartTime"] = format_time(start_time)
-    if end_time:
-        payload["EndTime"] = format_time(end_time)
-
-    r = requests.post(PULSEEM_URL, json=payload, headers=auth.headers(), timeout=timeout_seconds)
-    r.raise_for_status()
-    return r.json()
+class PulseemClient:
+    """
+    Pooled keep-alive client for the Pulseem API: one TCP+TLS handshake reused by the preflight,
+    the checkpoint and every OTP poll, gzip responses, bounded retry/backoff on 429/5xx.
+    """
+
+    def __init__(self, auth: PulseemAuth, pool_size: int = 4) -> None:
+        self.auth = auth
+        retry = Retry(
+            total=PULSEEM_RETRIES,
+            backoff_factor=PULSEEM_RETRY_BACKOFF,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({"POST"}),  # GetIncomingSmsReport is a read
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.headers.update(auth.headers())
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        self.session.headers["Connection"] = "keep-alive"
+
+    def incoming_sms_report(
+        self,
+        search_txt: Optional[str],
+        start_time: Optional[datetime],
+        end_time: Optional[datetime],
+        timeout_seconds: int = 20,
+    ) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {}
+        if search_txt:
+            payload["SearchTxt"] = search_txt[:31]
+        if start_time:
+            payload["StartTime"] = format_time(start_time)
+        if end_time:
+            payload["EndTime"] = format_time(end_time)
+
+        r = self.session.post(PULSEEM_URL, json=payload, timeout=timeout_seconds)
+        r.raise_for_status()
+        return r.json()
+
+    def connection_stats(self) -> Dict[str, int]:
+        """
+        urllib3 counts per pool: every new connection is a handshake, the rest of the requests reused one.
+        """
+        handshakes = sent = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            handshakes += pool.num_connections
+            sent += pool.num_requests
+        return {"requests": sent, "handshakes": handshakes, "reused": max(0, sent - handshakes)}
+
+
+_PULSEEM_CLIENTS: Dict[Tuple[str, str, str], PulseemClient] = {}
+_PULSEEM_CLIENTS_LOCK = threading.Lock()
+
+
+def get_pulseem_client(auth: PulseemAuth) -> PulseemClient:
+    key = (auth.api_key, auth.mode, auth.header_name)
+    with _PULSEEM_CLIENTS_LOCK:
+        client = _PULSEEM_CLIENTS.get(key)
+        if client is None:
+            client = _PULSEEM_CLIENTS[key] = PulseemClient(auth)
+        return client
+
+
+def log_pulseem_connection_stats() -> None:
+    for client in list(_PULSEEM_CLIENTS.values()):
+        st = client.connection_stats()
+        log.info(f"[Pulseem] HTTP requests={st['requests']} handshakes={st['handshakes']} reused={st['reused']}")
+
+
+SMS_CURSOR_FILE = "sms_cursor.json"
+
+
+def update_sms_cursor(virtual_number: str, newest: Optional[datetime], window_start: datetime) -> None:
+    """
+    Record the newest ReplyDate seen for this number after a successful query of [window_start, now].
+    The cursor stays "known up to now" only if this window found a message or overlaps the previous
+    coverage; otherwise there is a gap where unseen SMS may hide, and only the date is kept.
+    """
+    vn = normalize_il_number(virtual_number)
+    cursors = load_json_state(SMS_CURSOR_FILE, {})
+    prev = cursors.get(vn) or {}
+    prev_newest = datetime.fromisoformat(prev["newest"]) if prev.get("newest") else datetime.min
+    prev_covered = float(prev.get("covered_until") or 0)
+
+    found = newest is not None and newest != datetime.min
+    contiguous = found or window_start.timestamp() <= prev_covered
+    merged = max(prev_newest, newest or datetime.min)
+    cursors[vn] = {
+        "newest": merged.isoformat() if merged != datetime.min else None,
+        "covered_until": time.time() if contiguous else prev_covered,
+    }
+    save_json_state(SMS_CURSOR_FILE, cursors)
+
+
+def load_sms_cursor(virtual_number: str) -> Optional[Tuple[datetime, float]]:
+    """(newest known SMS date, covered_until epoch) or None if there is no coverage yet."""
+    cur = load_json_state(SMS_CURSOR_FILE, {}).get(normalize_il_number(virtual_number)) or {}
+    covered_until = float(cur.get("covered_until") or 0)
+    if not covered_until:
+        return None
+    newest = datetime.fromisoformat(cur["newest"]) if cur.get("newest") else datetime.min
+    return newest, covered_until
 
 
 def get_last_sms_datetime(
@@ -173,7 +707,7 @@ def get_last_sms_datetime(
     end = datetime.now()
 
     try:
-        data = get_incoming_sms_report(auth, search_txt=vn, start_time=start, end_time=end)
+        data = get_pulseem_client(auth).incoming_sms_report(search_txt=vn, start_time=start, end_time=end)
     except Exception:
         log.warning("[Pulseem] could not check last SMS")
         return datetime.min
@@ -183,10 +717,159 @@ def get_last_sms_datetime(
         return datetime.min
 
     reports = data.get("IncomingSmsReports", []) or []
-    if not reports:
-        return datetime.min
+    newest = max((parse_reply_date(str(m.get("ReplyDate", ""))) for m in reports), default=datetime.min)
+    update_sms_cursor(virtual_number, newest, start)
+    return newest
+
+
+class OtpPollSchedule:
+    """
+    Poll interval curve for the Pulseem wait (measured from the login submit):
+    - starts at OTP_POLL_MIN_SECONDS and backs off exponentially towards OTP_POLL_SECONDS
+    - drops back to OTP_POLL_MIN_SECONDS around the historically observed SMS arrival time
+    """
+
+    HISTORY_FILE = "otp_history.json"
+
+    def __init__(self, started_at: Optional[float] = None) -> None:
+        self.started_at = started_at or time.time()
+        history = load_json_state(self.HISTORY_FILE, {}).get("arrival_seconds", [])
+        self.expected_arrival = float(statistics.median(history)) if history else float(OTP_INITIAL_DELAY_SECONDS)
+
+    def next_interval(self) -> float:
+        elapsed = time.time() - self.started_at
+        until_window = self.expected_arrival - OTP_ARRIVAL_WINDOW_SECONDS - elapsed
+        if until_window <= 0 and elapsed <= self.expected_arrival + OTP_ARRIVAL_WINDOW_SECONDS:
+            return OTP_POLL_MIN_SECONDS
+
+        interval = OTP_POLL_MIN_SECONDS + (OTP_POLL_SECONDS - OTP_POLL_MIN_SECONDS) * (
+            1.0 - math.exp(-elapsed / max(OTP_POLL_BACKOFF_SECONDS, 0.001))
+        )
+        if until_window > 0:
+            # never sleep past the start of the arrival window
+            interval = min(interval, max(OTP_POLL_MIN_SECONDS, until_window))
+        return interval
 
-    return max((parse_reply_date(str(m.get("ReplyDate", ""))) for m in reports), default=datetime.min)
+    @classmethod
+    def record_arrival(cls, seconds: float) -> None:
+        history = load_json_state(cls.HISTORY_FILE, {}).get("arrival_seconds", [])
+        history = (history + [round(seconds, 2)])[-OTP_HISTORY_SIZE:]
+        save_json_state(cls.HISTORY_FILE, {"arrival_seconds": history})
+
+
+class OtpWebhookReceiver:
+    """
+    Embedded OTP endpoint, each route only when its setting is on:
+    - <path> (default /sms, OTP_WEBHOOK_ENABLED): inbound-SMS callback, Pulseem-style JSON/form (ReplyText/text/message/...)
+    - /otp (OTP_HTTP_ENABLED): a human or another system posts the code directly ({"code": "123456"})
+    The code is extracted with OTP_REGEX and wakes the OTP wait at once.
+    """
+
+    TEXT_KEYS = ("ReplyText", "text", "Text", "message", "Message", "body", "Body", "content", "code")
+
+    def __init__(self, host: str, port: int, path: str, token: str = "", sms: bool = True, direct: bool = True) -> None:
+        self.token = token
+        self._cond = threading.Condition()
+        self._codes: List[Tuple[str, Dict[str, Any]]] = []
+        routes = {}
+        if sms:
+            routes[path] = self._handle
+        if direct:
+            routes["/otp"] = self._handle
+        self.server = start_local_http_server(host, port, routes, name="OtpWebhook")
+
+    def arm(self) -> None:
+        """Forget anything received so far (called right before the login submit)."""
+        with self._cond:
+            self._codes.clear()
+
+    def _handle(self, method: str, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        if method != "POST":
+            return 405, {"error": "POST the inbound SMS"}
+        if self.token and body.get("token") != self.token:
+            return 403, {"error": "bad token"}
+
+        messages = body.get("IncomingSmsReports") or body.get("data") or [body]
+        if isinstance(messages, dict):
+            messages = [messages]
+
+        accepted = 0
+        for msg in messages:
+            if not isinstance(msg, dict):
+                continue
+            text = next((str(msg[k]) for k in self.TEXT_KEYS if msg.get(k)), "")
+            m = OTP_REGEX.search(text)
+            if not m:
+                continue
+            with self._cond:
+                self._codes.append((m.group(1), msg))
+                self._cond.notify_all()
+            accepted += 1
+
+        if accepted:
+            log.info(f"[OTP] Webhook delivered {accepted} code(s)")
+        return 200, {"accepted": accepted}
+
+    def wait_for_code(self, timeout_seconds: float) -> Optional[Tuple[str, Dict[str, Any]]]:
+        with self._cond:
+            if not self._cond.wait_for(lambda: bool(self._codes), timeout=max(0.0, timeout_seconds)):
+                return None
+            return self._codes.pop()
+
+    def source(self, stop: threading.Event) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """OTP broker source: wait for a pushed code until cancelled."""
+        while not stop.is_set():
+            hit = self.wait_for_code(0.25)
+            if hit:
+                return hit
+        return None
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+_OTP_WEBHOOK: Optional[OtpWebhookReceiver] = None
+
+
+def get_otp_webhook_receiver() -> Optional[OtpWebhookReceiver]:
+    """
+    Lazily start the receiver on the first login (OTP_WEBHOOK_ENABLED or OTP_HTTP_ENABLED).
+    """
+    global _OTP_WEBHOOK
+    if not (OTP_WEBHOOK_ENABLED or OTP_HTTP_ENABLED):
+        return None
+    if _OTP_WEBHOOK is None:
+        try:
+            _OTP_WEBHOOK = OtpWebhookReceiver(
+                OTP_WEBHOOK_HOST,
+                OTP_WEBHOOK_PORT,
+                OTP_WEBHOOK_PATH,
+                OTP_WEBHOOK_TOKEN,
+                sms=OTP_WEBHOOK_ENABLED,
+                direct=OTP_HTTP_ENABLED,
+            )
+        except OSError as e:
+            log.warning(f"[OTP] Could not start OTP HTTP endpoint on port {OTP_WEBHOOK_PORT}: {e}")
+            return None
+    return _OTP_WEBHOOK
+
+
+def send_fake_sms(text: str) -> None:
+    """
+    Local stand-in for the SMS provider: POST a Pulseem-like inbound SMS to our own receiver.
+    """
+    host = "127.0.0.1" if OTP_WEBHOOK_HOST in ("0.0.0.0", "") else OTP_WEBHOOK_HOST
+    url = f"http://{host}:{OTP_WEBHOOK_PORT}{OTP_WEBHOOK_PATH}"
+    payload = {
+        "ReplyText": text,
+        "ReplyDate": datetime.now().isoformat(timespec="seconds"),
+        "Telephone": normalize_il_number(PULSEEM_VIRTUAL_NUMBER),
+    }
+    if OTP_WEBHOOK_TOKEN:
+        payload["token"] = OTP_WEBHOOK_TOKEN
+    r = requests.post(url, json=payload, timeout=5)
+    log.info(f"[OTP] Fake SMS -> {url}: HTTP {r.status_code} {r.text}")
 
 
 def wait_for_otp_from_pulseem(
@@ -196,53 +879,76 @@ def wait_for_otp_from_pulseem(
     lookback_seconds: int = 240,
     max_wait_seconds: int = 90,
     poll_every_seconds: float = 2.0,
+    schedule: Optional[OtpPollSchedule] = None,
+    stop_event: Optional[threading.Event] = None,
 ) -> Tuple[str, Dict[str, Any]]:
     vn = normalize_il_number(virtual_number)
     start = datetime.now() - timedelta(seconds=lookback_seconds)
     deadline = time.time() + max_wait_seconds
+    client = get_pulseem_client(auth)
+    stop = stop_event or threading.Event()
+
+    def _sleep() -> None:
+        interval = schedule.next_interval() if schedule is not None else poll_every_seconds
+        stop.wait(max(0.0, min(interval, deadline - time.time())))
 
     last_seen_dt = after_datetime or datetime.min
     log.info(f"[OTP] Waiting for SMS newer than: {last_seen_dt.isoformat() if last_seen_dt != datetime.min else 'N/A'}")
 
-    while time.time() < deadline:
+    # Sliding window: StartTime follows the newest ReplyDate seen (minus skew), and messages
+    # already seen are skipped by identity, so each poll only parses what is new.
+    seen: Dict[Tuple[str, ...], datetime] = {}
+    skew = timedelta(seconds=OTP_WINDOW_SKEW_SECONDS)
+
+    while time.time() < deadline and not stop.is_set():
         end = datetime.now()
-        data = get_incoming_sms_report(auth, search_txt=vn, start_time=start, end_time=end)
+        data = client.incoming_sms_report(search_txt=vn, start_time=start, end_time=end)
 
         status = str(data.get("status", "")).lower()
         if status != "success":
             err = str(data.get("error") or "").lower()
             if "no data" in err:
-                time.sleep(poll_every_seconds)
+                update_sms_cursor(virtual_number, None, start)
+                _sleep()
                 continue
             raise RuntimeError(f"Pulseem error: {data.get('error')}")
 
         reports = data.get("IncomingSmsReports", []) or []
         if not reports:
-            time.sleep(poll_every_seconds)
+            update_sms_cursor(virtual_number, None, start)
+            _sleep()
             continue
 
-        fresh = []
-        newest_dt = last_seen_dt
+        fresh: List[Tuple[datetime, Dict[str, Any]]] = []
+        newest_dt = datetime.min
         for msg in reports:
+            ident = _sms_identity(msg)
+            if ident in seen:
+                continue
             dt_msg = parse_reply_date(str(msg.get("ReplyDate", "")))
+            seen[ident] = dt_msg
             if dt_msg > newest_dt:
                 newest_dt = dt_msg
             if dt_msg > last_seen_dt:
-                fresh.append(msg)
+                fresh.append((dt_msg, msg))
 
-        if newest_dt > last_seen_dt:
-            last_seen_dt = newest_dt
+        update_sms_cursor(virtual_number, newest_dt, start)
+        if newest_dt != datetime.min:
+            start = max(start, min(newest_dt, end) - skew)
+            seen = {k: v for k, v in seen.items() if v >= start}
 
-        fresh_sorted = sorted(fresh, key=lambda x: parse_reply_date(str(x.get("ReplyDate", ""))), reverse=True)
-        for msg in fresh_sorted:
+        fresh.sort(key=lambda x: x[0], reverse=True)
+        for _, msg in fresh:
             text = str(msg.get("ReplyText") or "")
             m = OTP_REGEX.search(text)
             if m:
                 log.info(f"[OTP] Found code: {m.group(1)}")
                 return m.group(1), msg
 
-        time.sleep(poll_every_seconds)
+        _sleep()
 
+    if stop.is_set():
+        raise OtpSourceCancelled("Pulseem polling cancelled")
     raise TimeoutError("No NEW OTP SMS arrived within the configured wait window.")
 
 
@@ -253,7 +959,36 @@ def build_pulseem_auth_from_env() -> PulseemAuth:
     return PulseemAuth(api_key=api_key, mode=PULSEEM_AUTH_MODE, header_name=PULSEEM_APIKEY_HEADER)
 
 
-def preflight_check_pulseem_or_die(virtual_number: str, lookback_seconds: int = 86400) -> None:
+def take_otp_checkpoint() -> datetime:
+    """
+    Newest SMS already on the virtual number; anything after it is treated as the new OTP.
+    The persisted cursor is used as-is only when it covers up to a few seconds ago; an older cursor
+    only narrows the query to the uncovered gap (an SMS in that gap must not pass as the new OTP).
+    """
+    cursor = load_sms_cursor(PULSEEM_VIRTUAL_NUMBER)
+    gap = time.time() - cursor[1] if cursor else math.inf
+    if cursor and gap <= SMS_CURSOR_FRESH_SECONDS:
+        log.info("[OTP] Checkpoint from persisted SMS cursor (no Pulseem query)")
+        return cursor[0]
+
+    auth = build_pulseem_auth_from_env()
+    if cursor and gap <= SMS_CURSOR_MAX_AGE_SECONDS:
+        lookback = int(math.ceil(gap + OTP_WINDOW_SKEW_SECONDS))
+        log.info(f"[OTP] SMS cursor covers up to {gap:.0f}s ago; querying only that gap")
+        return max(cursor[0], get_last_sms_datetime(PULSEEM_VIRTUAL_NUMBER, auth, lookback_seconds=lookback))
+    return get_last_sms_datetime(PULSEEM_VIRTUAL_NUMBER, auth, lookback_seconds=600)
+
+
+def _preflight_fingerprint(auth: PulseemAuth, vn: str) -> str:
+    raw = f"{auth.api_key}|{auth.mode}|{auth.header_name}|{vn}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def preflight_check_pulseem_or_die(
+    virtual_number: str,
+    lookback_seconds: int = PREFLIGHT_LOOKBACK_SECONDS,
+    use_cache: bool = True,
+) -> None:
     log.info("[Preflight] Checking Pulseem API connectivity/auth...")
 
     api_key = os.getenv("PULSEEM_API_KEY", "").strip()
@@ -262,11 +997,19 @@ def preflight_check_pulseem_or_die(virtual_number: str, lookback_seconds: int =
 
     auth = build_pulseem_auth_from_env()
     vn = normalize_il_number(virtual_number)
+
+    fingerprint = _preflight_fingerprint(auth, vn)
+    if use_cache:
+        cached = load_json_state("preflight.json", {})
+        age = time.time() - float(cached.get("ok_at") or 0)
+        if cached.get("fingerprint") == fingerprint and age < PREFLIGHT_CACHE_TTL_SECONDS:
+            log.info(f"[Preflight] Pulseem OK ✅ (cached {int(age)}s ago)")
+            return
+
     start = datetime.now() - timedelta(seconds=lookback_seconds)
     end = datetime.now()
 
-    data = get_incoming_sms_report(
-        auth=auth,
+    data = get_pulseem_client(auth).incoming_sms_report(
         search_txt=vn,
         start_time=start,
         end_time=end,
@@ -277,177 +1020,958 @@ def preflight_check_pulseem_or_die(virtual_number: str, lookback_seconds: int =
     err = str(data.get("error") or data.get("message") or "").strip()
 
     if status == "success":
-        log.info(f"[Preflight] Pulseem OK ✅ (success). Messages in lookback: {len(data.get('IncomingSmsReports', []) or [])}")
-        return
-    if "no data" in err.lower():
+        reports = data.get("IncomingSmsReports", []) or []
+        log.info(f"[Preflight] Pulseem OK ✅ (success). Messages in lookback: {len(reports)}")
+        newest = max((parse_reply_date(str(m.get("ReplyDate", ""))) for m in reports), default=datetime.min)
+        update_sms_cursor(virtual_number, newest, start)
+    elif "no data" in err.lower():
+        update_sms_cursor(virtual_number, None, start)
         log.info("[Preflight] Pulseem OK ✅ (NO DATA FOUND in lookback window)")
-        return
+    else:
+        raise RuntimeError(f"[Preflight] Pulseem FAILED ❌ status={data.get('status')} error={err}")
 
-    raise RuntimeError(f"[Preflight] Pulseem FAILED ❌ status={data.get('status')} error={err}")
+    save_json_state("preflight.json", {"fingerprint": fingerprint, "ok_at": time.time()})
 
 
 # ----------------------------
-# Playwright helpers
+# OTP broker (race all sources, first valid code wins)
 # ----------------------------
-def ensure_today_dir(base_dir: str) -> Path:
-    today_dir = Path(base_dir) / datetime.now().date().isoformat()
-    today_dir.mkdir(parents=True, exist_ok=True)
-    return today_dir
-
-
-def wait_page_ready(page, timeout_ms: int = 25000) -> None:
-    page.wait_for_load_state("domcontentloaded", timeout=timeout_ms)
-    try:
-        page.wait_for_function(
-            "document.readyState === 'complete' || document.readyState === 'interactive'",
-            timeout=timeout_ms,
-        )
-    except Exception:
-        pass
-    try:
-        page.wait_for_load_state("networkidle", timeout=timeout_ms)
-    except Exception:
-        pass
-    time.sleep(SETTLE_SLEEP)
+OtpHit = Tuple[str, Dict[str, Any]]
+OtpSource = Callable[[threading.Event], Optional[OtpHit]]
 
 
-def dismiss_overlays(page) -> None:
-    try:
-        dialog = page.locator('div[role="dialog"]:visible, .modal:visible, .popup:visible').first
-        if dialog.count() == 0:
-            return
-        close_btn = dialog.locator(
-            'button[aria-label*="סגור"], button[aria-label*="Close"], '
-            'button:has-text("סגור"), button:has-text("Close")'
-        ).first
-        if close_btn.is_visible(timeout=500):
-            close_btn.click(timeout=1500, force=True)
-            time.sleep(0.2)
-    except Exception:
-        pass
+class OtpSourceCancelled(RuntimeError):
+    pass
 
 
-def robust_click(page, *, locator=None, selector: Optional[str] = None, description: str = "click", timeout_ms: int = 20000) -> None:
+class OtpBroker:
     """
-    Supports hidden DOM:
-    - wait_for(state="attached")
-    - then click (normal -> force)
+    Runs every OTP source on its own thread. The first valid code wins and `stop` cancels the rest;
+    the whole race is bounded by a real deadline (input() used to block forever).
     """
-    if locator is None and selector is None:
-        raise ValueError("robust_click requires locator or selector")
 
-    for attempt in range(1, CLICK_RETRIES + 1):
+    def __init__(self, deadline_seconds: float) -> None:
+        self.deadline = time.time() + deadline_seconds
+        self.stop = threading.Event()
+        self._results: "queue.Queue[Tuple[str, Optional[OtpHit], Optional[BaseException]]]" = queue.Queue()
+        self.names: List[str] = []
+
+    def add(self, name: str, source: OtpSource) -> None:
+        def _run() -> None:
+            try:
+                self._results.put((name, source(self.stop), None))
+            except OtpSourceCancelled:
+                self._results.put((name, None, None))
+            except BaseException as e:
+                self._results.put((name, None, e))
+
+        self.names.append(name)
+        threading.Thread(target=_run, name=f"otp-{name}", daemon=True).start()
+
+    def wait(self) -> Tuple[str, OtpHit]:
+        pending = set(self.names)
+        errors: Dict[str, str] = {}
         try:
-            wait_page_ready(page, timeout_ms=timeout_ms)
-            dismiss_overlays(page)
+            while pending:
+                remaining = self.deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    name, hit, err = self._results.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                pending.discard(name)
+                if hit and re.fullmatch(r"\d{4,8}", hit[0] or ""):
+                    return name, hit
+                if err is not None:
+                    log.warning(f"[OTP] Source {name} failed: {err}")
+                    errors[name] = str(err)
+        finally:
+            self.stop.set()
 
-            loc = locator if locator is not None else page.locator(selector).first
-            loc.wait_for(state="attached", timeout=timeout_ms)
+        if pending:
+            raise TimeoutError(f"No OTP from any source ({', '.join(self.names)}) before the deadline. Errors: {errors}")
+        raise RuntimeError(f"All OTP sources failed: {errors}")
 
-            try:
-                loc.scroll_into_view_if_needed(timeout=timeout_ms)
-            except Exception:
-                pass
 
-            try:
-                loc.click(timeout=timeout_ms)
-            except Exception:
-                loc.click(timeout=timeout_ms, force=True)
+def _first_otp_code(text: str) -> Optional[str]:
+    m = OTP_REGEX.search(text or "")
+    return m.group(1) if m else None
 
-            log.info(f"[Click] ✅ {description} (attempt {attempt})")
-            wait_page_ready(page, timeout_ms=timeout_ms)
-            time.sleep(POST_CLICK_SLEEP)
-            return
 
-        except Exception as e:
-            log.warning(f"[Click] ❌ {description} failed (attempt {attempt}/{CLICK_RETRIES}): {e}")
-            time.sleep(CLICK_RETRY_BASE_SLEEP * attempt)
+def console_otp_source(stop: threading.Event) -> Optional[OtpHit]:
+    """
+    Non-blocking console prompt (select on POSIX, msvcrt on Windows) so it can be cancelled.
+    """
+    print("Enter OTP code (or wait for the SMS): ", end="", flush=True)
+    if os.name == "nt":
+        import msvcrt
+
+        buf = ""
+        while not stop.is_set():
+            if not msvcrt.kbhit():
+                stop.wait(0.1)
+                continue
+            ch = msvcrt.getwche()
+            if ch in ("\r", "\n"):
+                code = _first_otp_code(buf)
+                if code:
+                    return code, {"source": "console"}
+                buf = ""
+            elif ch == "\b":
+                buf = buf[:-1]
+            else:
+                buf += ch
+        return None
 
-    raise RuntimeError(f"Failed to click: {description} after {CLICK_RETRIES} attempts")
+    import select
 
+    while not stop.is_set():
+        ready, _, _ = select.select([sys.stdin], [], [], 0.25)
+        if not ready:
+            continue
+        line = sys.stdin.readline()
+        if not line:
+            return None  # EOF
+        code = _first_otp_code(line)
+        if code:
+            return code, {"source": "console"}
+    return None
 
-# ----------------------------
-# Frame helpers (CRITICAL FIX)
-# ----------------------------
-def _all_frames(page):
-    return page.frames  # includes main + iframes
 
+def otp_drop_file_path() -> Path:
+    return Path(OTP_DROP_FILE) if OTP_DROP_FILE else state_dir() / "otp.txt"
 
-def find_first_locator_in_any_frame(page, selector: str, timeout_ms_each: int = 1500):
+
+def drop_file_otp_source(stop: threading.Event, path: Path, armed_at: float) -> Optional[OtpHit]:
     """
-    Find selector across all frames; returns (frame, locator) if attached.
+    Another process writes the code to `path`: a regular file newer than `armed_at`
+    (consumed after reading), or a named pipe (POSIX mkfifo).
     """
-    for fr in _all_frames(page):
-        loc = fr.locator(selector).first
+    if path.exists() and stat.S_ISFIFO(path.stat().st_mode) and hasattr(os, "O_NONBLOCK"):
+        fd = os.open(str(path), os.O_RDONLY | os.O_NONBLOCK)
         try:
-            if loc.count() > 0:
-                loc.wait_for(state="attached", timeout=timeout_ms_each)
-                return fr, loc
-        except Exception:
-            continue
-    return None, None
-
+            buf = b""
+            while not stop.is_set():
+                try:
+                    chunk = os.read(fd, 256)
+                except BlockingIOError:
+                    chunk = b""
+                if not chunk:
+                    stop.wait(0.2)
+                    continue
+                buf += chunk
+                code = _first_otp_code(buf.decode("utf-8", errors="replace"))
+                if code:
+                    return code, {"source": str(path)}
+        finally:
+            os.close(fd)
+        return None
 
-def robust_click_in_frame(page, frame, locator, description: str, timeout_ms: int = 20000):
-    """
-    Click locator that belongs to a frame; supports hidden tags.
-    """
-    for attempt in range(1, CLICK_RETRIES + 1):
+    while not stop.is_set():
         try:
-            wait_page_ready(page, timeout_ms=timeout_ms)
-            dismiss_overlays(page)
+            if path.stat().st_mtime >= armed_at:
+                code = _first_otp_code(path.read_text(encoding="utf-8", errors="replace"))
+                if code:
+                    path.unlink()
+                    return code, {"source": str(path)}
+        except FileNotFoundError:
+            pass
+        stop.wait(0.25)
+    return None
 
-            locator.wait_for(state="attached", timeout=timeout_ms)
 
-            try:
-                locator.scroll_into_view_if_needed(timeout=timeout_ms)
-            except Exception:
-                pass
+# ----------------------------
+# Playwright helpers
+# ----------------------------
+def ensure_today_dir(base_dir: str) -> Path:
+    today_dir = Path(base_dir) / datetime.now().date().isoformat()
+    today_dir.mkdir(parents=True, exist_ok=True)
+    return today_dir
+
+
+NETWORK_STATS: Dict[str, int] = {"networkidle_waits": 0, "networkidle_timeouts": 0, "quiet_waits": 0, "quiet_timeouts": 0}
 
-            try:
-                locator.click(timeout=timeout_ms)
-            except Exception:
-                locator.click(timeout=timeout_ms, force=True)
 
-            log.info(f"[Click] ✅ {description} (attempt {attempt})")
-            wait_page_ready(page, timeout_ms=timeout_ms)
-            time.sleep(POST_CLICK_SLEEP)
+class RequestTracker:
+    """
+    In-flight requests of one page (request / requestfinished / requestfailed events),
+    ignoring websockets, event streams and NETWORK_IGNORE_PATTERNS.
+    """
+
+    def __init__(self, page, ignore_patterns: Sequence[str] = tuple(NETWORK_IGNORE_PATTERNS)) -> None:
+        self.page = page
+        self.ignore_patterns = tuple(ignore_patterns)
+        self.inflight: Dict[int, str] = {}
+        self.last_change = time.time()
+        page.on("request", self._on_request)
+        page.on("requestfinished", self._on_done)
+        page.on("requestfailed", self._on_done)
+
+    def _ignored(self, request) -> bool:
+        if request.resource_type in ("websocket", "eventsource"):
+            return True
+        url = request.url
+        return any(p in url for p in self.ignore_patterns)
+
+    def _on_request(self, request) -> None:
+        if not self._ignored(request):
+            self.inflight[id(request)] = request.url
+            self.last_change = time.time()
+
+    def _on_done(self, request) -> None:
+        if self.inflight.pop(id(request), None) is not None:
+            self.last_change = time.time()
+
+    def wait_for_quiet(self, quiet_ms: int = NETWORK_QUIET_MS, timeout_ms: int = 25000) -> bool:
+        """
+        Quiet except for known background traffic. Returns False (and counts it) on timeout.
+        """
+        NETWORK_STATS["quiet_waits"] += 1
+        deadline = time.time() + timeout_ms / 1000.0
+        while True:
+            now = time.time()
+            if not self.inflight and (now - self.last_change) * 1000 >= quiet_ms:
+                return True
+            if now >= deadline:
+                NETWORK_STATS["quiet_timeouts"] += 1
+                log.info(f"[Ready] Network not quiet after {timeout_ms}ms, still in flight: {list(self.inflight.values())[:3]}")
+                return False
+            self.page.wait_for_timeout(50)
+
+
+_REQUEST_TRACKERS: "weakref.WeakKeyDictionary[Any, RequestTracker]" = weakref.WeakKeyDictionary()
+
+
+def get_request_tracker(page) -> RequestTracker:
+    tracker = _REQUEST_TRACKERS.get(page)
+    if tracker is None:
+        tracker = _REQUEST_TRACKERS[page] = RequestTracker(page)
+    return tracker
+
+
+def install_request_tracking(context) -> None:
+    """Attach a tracker to every page (and popup) of the context as soon as it opens."""
+    for pg in context.pages:
+        get_request_tracker(pg)
+    context.on("page", get_request_tracker)
+
+
+def log_network_stats() -> None:
+    st = NETWORK_STATS
+    line = f"[Ready] quiet waits={st['quiet_waits']} (timeouts={st['quiet_timeouts']})"
+    if st["networkidle_waits"]:  # only with LEGACY_PAGE_READY + PAGE_READY_NETWORKIDLE
+        line += f", networkidle waits={st['networkidle_waits']} (timeouts={st['networkidle_timeouts']})"
+    log.info(line)
+    # Images switched off in Blink are never requested, so there is nothing to count for them
+    images_note = "; images disabled in Blink (not requested, not counted)" if BLINK_IMAGES_DISABLED else ""
+    if BLOCKED_STATS:
+        total = sum(v["count"] for v in BLOCKED_STATS.values())
+        saved = sum(v["bytes"] for v in BLOCKED_STATS.values())
+        parts = ", ".join(f"{k}={v['count']}" for k, v in sorted(BLOCKED_STATS.items()))
+        log.info(f"[Block] blocked {total} request(s) ({parts}), ~{saved / 1024:.0f} KiB saved (estimated){images_note}")
+    elif images_note:
+        log.info(f"[Block] no requests blocked by URL{images_note}")
+
+
+# Blocked requests never download, so bytes saved use typical sizes per resource type
+BLOCKED_SIZE_ESTIMATE = {"image": 25_000, "font": 60_000, "media": 500_000, "script": 40_000, "stylesheet": 20_000}
+BLOCKED_STATS: Dict[str, Dict[str, int]] = {}
+BLINK_IMAGES_DISABLED = False  # set once a browser was launched with blocking_launch_args()
+
+# Network.setBlockedURLs only knows URL wildcards, so resource types map to file extensions
+# (images without an extension are still covered by the Blink setting from blocking_launch_args)
+BLOCK_TYPE_URL_PATTERNS = {
+    "image": ("*.png*", "*.jpg*", "*.jpeg*", "*.gif*", "*.webp*", "*.svg*", "*.ico*", "*.bmp*"),
+    "font": ("*.woff*", "*.ttf*", "*.otf*", "*.eot*"),
+    "media": ("*.mp4*", "*.webm*", "*.mp3*", "*.ogg*", "*.mov*", "*.avi*"),
+}
+
+
+def blocked_url_patterns() -> List[str]:
+    if not BLOCK_RESOURCES:
+        return []
+    patterns = [pat for t in BLOCK_RESOURCE_TYPES for pat in BLOCK_TYPE_URL_PATTERNS.get(t, ())]
+    patterns += [f"*{p}*" for p in BLOCK_URL_PATTERNS]
+    return [pat for pat in patterns if not any(a in pat for a in BLOCK_ALLOW_PATTERNS)]
+
+
+def blocking_launch_args() -> List[str]:
+    """Browser-wide part of the policy (launch / launch_persistent_context args)."""
+    global BLINK_IMAGES_DISABLED
+    if BLOCK_RESOURCES and "image" in BLOCK_RESOURCE_TYPES and not any("image" in a for a in BLOCK_ALLOW_PATTERNS):
+        BLINK_IMAGES_DISABLED = True
+        return ["--blink-settings=imagesEnabled=false"]
+    return []
+
+
+def _block_on_page(context, page, patterns: List[str]) -> None:
+    try:
+        cdp = context.new_cdp_session(page)
+        cdp.send("Network.enable")
+        cdp.send("Network.setBlockedURLs", {"urls": patterns})
+    except Exception as e:
+        log.info(f"[Block] CDP blocking not available for this page: {e}")
+        return
+
+    def _on_failed(params: Dict[str, Any]) -> None:
+        if params.get("blockedReason") != "inspector":  # "inspector" = our setBlockedURLs
             return
-        except Exception as e:
-            log.warning(f"[Click] ❌ {description} failed (attempt {attempt}/{CLICK_RETRIES}): {e}")
-            time.sleep(CLICK_RETRY_BASE_SLEEP * attempt)
+        rtype = str(params.get("type") or "other").lower()
+        st = BLOCKED_STATS.setdefault(rtype, {"count": 0, "bytes": 0})
+        st["count"] += 1
+        st["bytes"] += BLOCKED_SIZE_ESTIMATE.get(rtype, 5_000)
 
-    raise RuntimeError(f"Failed to click: {description} after {CLICK_RETRIES} attempts")
+    cdp.on("Network.loadingFailed", _on_failed)
+
+
+def install_resource_blocking(context) -> None:
+    """
+    Block images/fonts/media and analytics per BLOCK_* settings on every page (and popup) of the context.
+    Chromium drops the requests itself: no per-request Python round-trip, HTTP cache untouched.
+    """
+    patterns = blocked_url_patterns()
+    if not patterns:
+        return
+    for pg in context.pages:
+        _block_on_page(context, pg, patterns)
+    context.on("page", lambda pg: _block_on_page(context, pg, patterns))
+
+
+def wait_page_ready(page, timeout_ms: int = 25000) -> None:
+    page.wait_for_load_state("domcontentloaded", timeout=timeout_ms)
+    try:
+        page.wait_for_function(
+            "document.readyState === 'complete' || document.readyState === 'interactive'",
+            timeout=timeout_ms,
+        )
+    except Exception:
+        pass
+    if PAGE_READY_NETWORKIDLE:
+        NETWORK_STATS["networkidle_waits"] += 1
+        try:
+            page.wait_for_load_state("networkidle", timeout=timeout_ms)
+        except Exception:
+            NETWORK_STATS["networkidle_timeouts"] += 1
+    else:
+        get_request_tracker(page).wait_for_quiet(timeout_ms=timeout_ms)
+    page.wait_for_timeout(SETTLE_SLEEP * 1000)
+
+
+@dataclass
+class PostCondition:
+    """
+    What a step actually needs before the flow can continue, so the bot waits for exactly that
+    instead of networkidle + a settle sleep.
+    kind: selector | locator | url | response | load | quiet | any (first of several, e.g. next screen or redirect)
+    required=False: a soft signal, waited for briefly (OPTIONAL_POSTCONDITION_MS) and skipped if absent.
+    """
+
+    kind: str
+    target: Any = None
+    state: str = "attached"
+    any_frame: bool = False
+    required: bool = True
+
+    @classmethod
+    def selector(cls, selector: str, state: str = "attached", any_frame: bool = False) -> "PostCondition":
+        return cls("selector", selector, state=state, any_frame=any_frame)
+
+    @classmethod
+    def locator(cls, locator, state: str = "visible") -> "PostCondition":
+        return cls("locator", locator, state=state)
+
+    @classmethod
+    def url(cls, pattern: Union[str, "re.Pattern[str]", Callable[[str], bool]]) -> "PostCondition":
+        return cls("url", pattern)
+
+    @classmethod
+    def response(cls, match: Union[str, "re.Pattern[str]", Callable[[Any], bool]], required: bool = True) -> "PostCondition":
+        return cls("response", match, required=required)
+
+    @classmethod
+    def load(cls, state: str = "domcontentloaded") -> "PostCondition":
+        return cls("load", state)
+
+    @classmethod
+    def quiet(cls, quiet_ms: int = NETWORK_QUIET_MS, required: bool = False) -> "PostCondition":
+        return cls("quiet", quiet_ms, required=required)
+
+    @classmethod
+    def any_of(cls, *conds: "PostCondition") -> "PostCondition":
+        """Holds as soon as one of `conds` does (no response kinds: those must be armed)."""
+        return cls("any", tuple(conds))
+
+
+Expectation = Union[PostCondition, Sequence[PostCondition], None]
+
+
+def is_postback_response(response) -> bool:
+    """ASP.NET postback / grid refresh: any POST document or XHR answered by the server."""
+    req = response.request
+    return req.method == "POST" and req.resource_type in ("document", "xhr", "fetch")
+
+
+def _response_predicate(match) -> Callable[[Any], bool]:
+    if callable(match):
+        return match
+    if isinstance(match, re.Pattern):
+        return lambda r: bool(match.search(r.url))
+    return lambda r: str(match) in r.url
+
+
+def _wait_selector_in_any_frame(page, selector: str, state: str, timeout_ms: int) -> None:
+    deadline = time.time() + timeout_ms / 1000.0
+    while True:
+        for fr in page.frames:
+            try:
+                loc = fr.locator(selector).first
+                if loc.count() > 0 and (state != "visible" or loc.is_visible()):
+                    return
+            except Exception:
+                continue
+        if time.time() >= deadline:
+            raise PWTimeout(f"Timeout {timeout_ms}ms waiting for {selector!r} in any frame")
+        page.wait_for_timeout(100)
+
+
+def wait_for_postcondition(page, cond: PostCondition, timeout_ms: int) -> None:
+    if cond.kind == "selector":
+        if cond.any_frame:
+            _wait_selector_in_any_frame(page, cond.target, cond.state, timeout_ms)
+        else:
+            page.locator(cond.target).first.wait_for(state=cond.state, timeout=timeout_ms)
+    elif cond.kind == "locator":
+        cond.target.wait_for(state=cond.state, timeout=timeout_ms)
+    elif cond.kind == "url":
+        page.wait_for_url(cond.target, wait_until="commit", timeout=timeout_ms)
+    elif cond.kind == "load":
+        page.wait_for_load_state(cond.target or "domcontentloaded", timeout=timeout_ms)
+    elif cond.kind == "quiet":
+        if not get_request_tracker(page).wait_for_quiet(quiet_ms=cond.target or NETWORK_QUIET_MS, timeout_ms=timeout_ms):
+            raise PWTimeout(f"Timeout {timeout_ms}ms waiting for quiet network")
+    elif cond.kind == "any":
+        deadline = time.time() + timeout_ms / 1000.0
+        while True:
+            for sub in cond.target:
+                try:
+                    wait_for_postcondition(page, sub, ANY_POSTCONDITION_SLICE_MS)
+                    return
+                except PWTimeout:
+                    pass
+            if time.time() >= deadline:
+                raise PWTimeout(f"Timeout {timeout_ms}ms waiting for any of: {', '.join(c.kind for c in cond.target)}")
+    elif cond.kind == "response":
+        raise ValueError("response post-conditions must be armed before the action (run_with_postconditions)")
+    else:
+        raise ValueError(f"Unknown post-condition kind: {cond.kind}")
+
+
+def run_with_postconditions(page, action: Callable[[], None], expect: Expectation, timeout_ms: int) -> None:
+    """
+    Run `action`, then wait for every declared post-condition. Responses are recorded from before
+    the action so a fast response is not missed.
+    """
+    if expect is None:
+        conds: List[PostCondition] = []
+    elif isinstance(expect, PostCondition):
+        conds = [expect]
+    else:
+        conds = list(expect)
+
+    seen: List[Any] = []
+
+    def _record(response) -> None:
+        seen.append(response)
+
+    watching = any(c.kind == "response" for c in conds)
+    if watching:
+        page.on("response", _record)
+    try:
+        action()
+        for c in conds:
+            wait_ms = timeout_ms if c.required else min(timeout_ms, OPTIONAL_POSTCONDITION_MS)
+            try:
+                if c.kind == "response":
+                    pred = _response_predicate(c.target)
+                    if not any(pred(r) for r in seen):
+                        page.wait_for_event("response", predicate=pred, timeout=wait_ms)
+                else:
+                    wait_for_postcondition(page, c, wait_ms)
+            except PWTimeout:
+                if c.required:
+                    raise
+                log.info(f"[Ready] Optional {c.kind} post-condition not seen within {wait_ms}ms, continuing")
+    finally:
+        if watching:
+            page.remove_listener("response", _record)
+
+
+def dismiss_overlays(page) -> None:
+    try:
+        dialog = page.locator('div[role="dialog"]:visible, .modal:visible, .popup:visible').first
+        if dialog.count() == 0:
+            return
+        close_btn = dialog.locator(
+            'button[aria-label*="סגור"], button[aria-label*="Close"], '
+            'button:has-text("סגור"), button:has-text("Close")'
+        ).first
+        if close_btn.is_visible(timeout=500):
+            close_btn.click(timeout=1500, force=True)
+            page.wait_for_timeout(200)
+    except Exception:
+        pass
+
+
+# ----------------------------
+# Overlay auto-dismiss (in-page)
+# ----------------------------
+# Same targets as dismiss_overlays(): visible dialog/modal/popup with a "סגור"/"Close" button.
+# Runs in every frame of every page; each close is reported back through an exposed binding.
+OVERLAY_DISMISS_SCRIPT = r"""
+(() => {
+  if (window.__harelOverlayObserver) return;
+  const DIALOGS = 'div[role="dialog"], .modal, .popup';
+  const CLOSE_TEXT = /סגור|close/i;
+  const clicks = new WeakMap();
+
+  const isVisible = (el) => {
+    if (!(el.offsetWidth || el.offsetHeight || el.getClientRects().length)) return false;
+    const st = getComputedStyle(el);
+    return st.visibility !== 'hidden' && st.display !== 'none';
+  };
+  const findClose = (dlg) => {
+    for (const b of dlg.querySelectorAll('button')) {
+      if (CLOSE_TEXT.test((b.getAttribute('aria-label') || '') + ' ' + (b.textContent || ''))) return b;
+    }
+    return null;
+  };
+  const sweep = () => {
+    for (const dlg of document.querySelectorAll(DIALOGS)) {
+      if (!isVisible(dlg)) continue;
+      const n = clicks.get(dlg) || 0;
+      const btn = n < 3 ? findClose(dlg) : null;
+      if (!btn) continue;
+      clicks.set(dlg, n + 1);
+      btn.click();
+      const label = String(dlg.getAttribute('aria-label') || dlg.className || dlg.tagName).slice(0, 80);
+      try { window.__harelOverlayDismissed && window.__harelOverlayDismissed(location.href, label); } catch (e) {}
+    }
+  };
+
+  let timer = null;
+  const schedule = () => { if (!timer) timer = setTimeout(() => { timer = null; sweep(); }, 30); };
+  window.__harelOverlayObserver = new MutationObserver(schedule);
+  const start = () => {
+    window.__harelOverlayObserver.observe(document.documentElement, {
+      childList: true, subtree: true, attributes: true, attributeFilter: ['class', 'style', 'hidden', 'aria-hidden', 'open'],
+    });
+    sweep();
+  };
+  if (document.documentElement) start(); else document.addEventListener('DOMContentLoaded', start);
+})();
+"""
+
+OVERLAY_STATS: Dict[str, int] = {"dismissed": 0}
+
+
+def _on_overlay_dismissed(source: Dict[str, Any], url: str, label: str) -> None:
+    OVERLAY_STATS["dismissed"] += 1
+    log.info(f"[Overlay] Auto-dismissed {label!r} on {url}")
+
+
+def install_overlay_autodismiss(context) -> None:
+    """Once per context, before pages are opened."""
+    if not OVERLAY_AUTODISMISS:
+        return
+    context.expose_binding("__harelOverlayDismissed", _on_overlay_dismissed)
+    context.add_init_script(OVERLAY_DISMISS_SCRIPT)
+
+
+# ----------------------------
+# Click engine
+# ----------------------------
+# Failure classes; only the ones where another attempt can help are retried
+CLICK_RETRYABLE = {"detached", "intercepted", "navigation", "postcondition"}
+
+CLICK_STATS: Dict[str, Dict[str, float]] = {}
+
+
+class ClickError(RuntimeError):
+    def __init__(self, description: str, kind: str, cause: BaseException, attempts: int) -> None:
+        super().__init__(f"Failed to click: {description} [{kind}] after {attempts} attempt(s): {cause}")
+        self.kind = kind
+        self.attempts = attempts
+
+
+def classify_click_failure(stage: str, e: BaseException) -> str:
+    """
+    stage: locate (waiting for the element) | click | postcondition
+    """
+    msg = str(e).lower()
+    if "execution context was destroyed" in msg or "navigat" in msg or "frame was detached" in msg:
+        return "navigation"
+    if stage == "locate":
+        return "not_found"
+    if stage == "postcondition":
+        return "postcondition"
+    if "not attached" in msg or "detached" in msg:
+        return "detached"
+    if "intercepts pointer events" in msg or "intercept" in msg:
+        return "intercepted"
+    if isinstance(e, PWTimeout):
+        return "timeout"
+    return "other"
+
+
+def _toggle_took_effect(page, locator, expect: Expectation) -> bool:
+    """A toggle whose post-condition was slow: is it open already (aria-expanded, or the condition holds now)?"""
+    try:
+        if (locator.get_attribute("aria-expanded", timeout=1000) or "").strip().lower() == "true":
+            return True
+    except Exception:
+        pass
+    conds = [expect] if isinstance(expect, PostCondition) else list(expect or [])
+    for c in conds:
+        if c.kind == "response":
+            continue
+        try:
+            wait_for_postcondition(page, c, ANY_POSTCONDITION_SLICE_MS)
+            return True
+        except Exception:
+            pass
+    return False
+
+
+def click_with_postcondition(
+    page,
+    locator,
+    description: str,
+    timeout_ms: int = 20000,
+    expect: Expectation = None,
+    retries: int = CLICK_RETRIES,
+    toggle: bool = False,
+) -> None:
+    """
+    One click engine for page and frame locators (supports hidden DOM):
+    - wait_for(state="attached")
+    - click (normal -> force when intercepted/timed out)
+    - success = the declared post-condition(s) hold, not "we slept long enough"
+    - retry only failures another attempt can fix; time and retries are counted per description
+    - toggle=True (drawers, dropdowns): after a slow post-condition, a toggle that is already open
+      is not clicked again (that would close it); the retry only waits
+    """
+    stats = CLICK_STATS.setdefault(description, {"clicks": 0, "attempts": 0, "retries": 0, "failures": 0, "ms": 0.0})
+    started = time.time()
+
+    requested_ms = timeout_ms
+    latency_key = f"click:{description}"
+    # set once a learned (shortened) timeout ran out; a single-shot click gets the full ceiling up front
+    use_fixed = retries <= 1
+    toggled_open = False
+    attempt = 0
+    while attempt < retries:
+        attempt += 1
+        # learned timeout (grows per retry), capped by the call's fixed value and the step's budget
+        learned_ms = requested_ms if use_fixed else adaptive_timeout_ms(latency_key, requested_ms, attempt)
+        timeout_ms = budget_ms(learned_ms)
+        attempt_started = time.time()
+        stats["attempts"] += 1
+        stage = "locate"
+        try:
+            if LEGACY_PAGE_READY:
+                wait_page_ready(page, timeout_ms=timeout_ms)
+            if not OVERLAY_AUTODISMISS:
+                dismiss_overlays(page)
+
+            locator.wait_for(state="attached", timeout=timeout_ms)
+
+            try:
+                locator.scroll_into_view_if_needed(timeout=timeout_ms)
+            except Exception:
+                pass
+
+            stage = "click"
+
+            def _click() -> None:
+                nonlocal stage
+                if toggled_open:
+                    stage = "postcondition"
+                    return
+                try:
+                    locator.click(timeout=timeout_ms)
+                except Exception as e:
+                    if classify_click_failure("click", e) not in ("intercepted", "timeout"):
+                        raise
+                    locator.click(timeout=timeout_ms, force=True)
+                stage = "postcondition"
+
+            run_with_postconditions(page, _click, expect, timeout_ms)
+            if LEGACY_PAGE_READY:
+                wait_page_ready(page, timeout_ms=timeout_ms)
+                page.wait_for_timeout(POST_CLICK_SLEEP * 1000)
+
+            elapsed_ms = (time.time() - started) * 1000
+            record_latency(latency_key, (time.time() - attempt_started) * 1000)
+            stats["clicks"] += 1
+            stats["ms"] += elapsed_ms
+            log.info(f"[Click] ✅ {description} (attempt {attempt}, {elapsed_ms:.0f} ms)")
+            return
+
+        except Exception as e:
+            kind = classify_click_failure(stage, e)
+            if toggle and kind == "postcondition" and not toggled_open and _toggle_took_effect(page, locator, expect):
+                toggled_open = True
+                log.info(f"[Click] {description}: toggle is open, later attempts only wait for the post-condition")
+            if learned_ms < requested_ms and kind in ("not_found", "timeout", "postcondition"):
+                # a slow day, not a broken page: one more go with the fixed ceiling before giving up
+                use_fixed = True
+                retries = max(retries, attempt + 1)
+                stats["retries"] += 1
+                log.warning(
+                    f"[Click] ❌ {description} ran out of its learned {learned_ms} ms [{kind}], "
+                    f"retrying with {requested_ms} ms"
+                )
+                continue
+            if kind not in CLICK_RETRYABLE or attempt == retries:
+                stats["failures"] += 1
+                stats["ms"] += (time.time() - started) * 1000
+                log.warning(f"[Click] ❌ {description} failed [{kind}] (attempt {attempt}/{retries}), giving up: {e}")
+                raise ClickError(description, kind, e, attempt) from e
+            stats["retries"] += 1
+            log.warning(f"[Click] ❌ {description} failed [{kind}] (attempt {attempt}/{retries}), retrying: {e}")
+            if kind == "intercepted" and OVERLAY_AUTODISMISS:
+                dismiss_overlays(page)  # something the in-page dismisser doesn't know about
+            page.wait_for_timeout(CLICK_RETRY_BASE_SLEEP * attempt * 1000)
+
+    raise ClickError(description, "other", RuntimeError("no attempts"), 0)
+
+
+def robust_click(
+    page,
+    *,
+    locator=None,
+    selector: Optional[str] = None,
+    description: str = "click",
+    timeout_ms: int = 20000,
+    expect: Expectation = None,
+    retries: int = CLICK_RETRIES,
+    toggle: bool = False,
+) -> None:
+    if locator is None and selector is None:
+        raise ValueError("robust_click requires locator or selector")
+    loc = locator if locator is not None else page.locator(selector).first
+    click_with_postcondition(
+        page, loc, description, timeout_ms=timeout_ms, expect=expect, retries=retries, toggle=toggle
+    )
+
+
+def log_click_stats() -> None:
+    for desc, st in CLICK_STATS.items():
+        avg = st["ms"] / max(1.0, st["clicks"] + st["failures"])
+        log.info(
+            f"[Click] {desc}: ok={int(st['clicks'])} failed={int(st['failures'])} "
+            f"retries={int(st['retries'])} avg={avg:.0f} ms"
+        )
+
+
+# ----------------------------
+# Selector strategy cache
+# ----------------------------
+STRATEGY_CACHE_FILE = "strategy_cache.json"
+
+
+def order_strategies(step: str, names: Sequence[str]) -> List[str]:
+    """
+    Known-good first (fastest on top), then untried in declared order, then failing ones
+    (longest failure streak last).
+    """
+    if not STRATEGY_CACHE_ENABLED:
+        return list(names)
+    entries = load_json_state(STRATEGY_CACHE_FILE, {}).get(step) or {}
+
+    def _key(item: Tuple[int, str]) -> Tuple[int, float, int]:
+        i, name = item
+        e = entries.get(name)
+        if not e:
+            return (1, 0.0, i)
+        streak = int(e.get("streak") or 0)
+        if streak > 0:
+            return (0, float(e.get("ms") or 0), i)
+        return (2, float(-streak), i)
+
+    ordered = [name for _, name in sorted(enumerate(names), key=_key)]
+    if ordered != list(names):
+        log.info(f"[Strategy] {step}: trying {ordered[0]!r} first (cached)")
+    return ordered
+
+
+def record_strategy(step: str, name: str, ok: bool, ms: float, frame: str = "") -> None:
+    """streak > 0: consecutive successes, < 0: consecutive failures; ms is an EWMA of successes."""
+    if not STRATEGY_CACHE_ENABLED:
+        return
+    cache = load_json_state(STRATEGY_CACHE_FILE, {})
+    e = cache.setdefault(step, {}).setdefault(name, {"ok": 0, "fail": 0, "streak": 0, "ms": None, "frame": ""})
+    if ok:
+        e["ok"] += 1
+        e["streak"] = max(0, int(e["streak"])) + 1
+        e["ms"] = round(ms if e["ms"] is None else 0.7 * float(e["ms"]) + 0.3 * ms, 1)
+        e["last_ok"] = datetime.now().isoformat(timespec="seconds")
+        if frame:
+            e["frame"] = frame
+    else:
+        e["fail"] += 1
+        e["streak"] = min(0, int(e["streak"])) - 1
+        e["last_fail"] = datetime.now().isoformat(timespec="seconds")
+    save_json_state(STRATEGY_CACHE_FILE, cache)
+
+
+def strategy_frame_hint(step: str, name: str) -> str:
+    if not STRATEGY_CACHE_ENABLED:
+        return ""
+    e = (load_json_state(STRATEGY_CACHE_FILE, {}).get(step) or {}).get(name) or {}
+    return e.get("frame") or ""
+
+
+# ----------------------------
+# Frame helpers (CRITICAL FIX)
+# ----------------------------
+def _all_frames(page):
+    return page.frames  # includes main + iframes
+
+
+def frame_key(frame) -> str:
+    """Stable-ish frame identity across runs: name, else URL path."""
+    return frame.name or urlparse(frame.url or "").path
+
+
+@dataclass(frozen=True)
+class LinkStrategy:
+    """One way to recognise a link: href substring and/or text (has-text semantics), optionally visible only."""
+    name: str
+    href: str = ""
+    text: str = ""
+    visible: bool = False
+
+
+# Ranks every strategy against the frame's <a> elements in one go; the best hit gets a
+# data attribute so Python can address exactly that element with a plain locator.
+RESOLVE_LINK_JS = r"""
+([strategies, token]) => {
+  const norm = (s) => (s || '').replace(/\s+/g, ' ').trim().toLowerCase();
+  const isVisible = (el) => {
+    const r = el.getBoundingClientRect();
+    if (!r.width || !r.height) return false;
+    return getComputedStyle(el).visibility !== 'hidden';
+  };
+  const links = Array.from(document.querySelectorAll('a'));
+  for (let rank = 0; rank < strategies.length; rank++) {
+    const st = strategies[rank];
+    const text = norm(st.text);
+    const hit = links.find((a) =>
+      (!st.href || (a.getAttribute('href') || '').includes(st.href)) &&
+      (!text || norm(a.textContent).includes(text)) &&
+      (!st.visible || isVisible(a)));
+    if (hit) {
+      hit.setAttribute('data-harel-bot-pick', token);
+      return rank;
+    }
+  }
+  return -1;
+}
+"""
+
+RESOLVE_POLL_SECONDS = 0.25
+_RESOLVE_SEQ = itertools.count(1)
+
+
+def resolve_link_in_any_frame(
+    page,
+    strategies: Sequence[LinkStrategy],
+    timeout_ms: int = 15000,
+    frame_hint: str = "",
+):
+    """
+    Single-pass resolver: one evaluate per frame checks all strategies, the best rank over
+    all frames wins. Repeats inside one bounded wait until something matches.
+    frame_hint (see frame_key) is scanned first so a rank-0 hit there ends the scan early.
+    Returns (frame, locator, strategy) or (None, None, None).
+    """
+    payload = [{"href": s.href, "text": s.text, "visible": s.visible} for s in strategies]
+    deadline = time.time() + timeout_ms / 1000.0
+    while True:
+        token = f"pick-{next(_RESOLVE_SEQ)}"
+        best: Optional[Tuple[int, Any]] = None
+        frames = sorted(_all_frames(page), key=lambda f: frame_key(f) != frame_hint) if frame_hint else _all_frames(page)
+        for fr in frames:
+            try:
+                rank = fr.evaluate(RESOLVE_LINK_JS, [payload, token])
+            except Exception:
+                continue  # frame navigated/detached mid-scan
+            if rank >= 0 and (best is None or rank < best[0]):
+                best = (rank, fr)
+                if rank == 0:
+                    break
+        if best is not None:
+            rank, fr = best
+            return fr, fr.locator(f'a[data-harel-bot-pick="{token}"]').first, strategies[rank]
+        if time.time() >= deadline:
+            return None, None, None
+        page.wait_for_timeout(RESOLVE_POLL_SECONDS * 1000)
 
 
 # ----------------------------
 # Navigation: go to portal after OTP
 # ----------------------------
-def goto_main_portal(page) -> None:
+FAV_BUTTON_SELECTOR = 'button[data-hrl-bo="atm-drowerButton"][aria-label="מועדפים"]'
+
+# Where the portal sends us when the session is gone (see readme: my.logout.php3?errorcode=19)
+LOGGED_OUT_URL_REGEX = re.compile(r"my\.logout\.php3|my\.policy", re.IGNORECASE)
+
+
+def goto_main_portal(page, timeout_ms: int = 30000) -> None:
     log.info(f"[Nav] Going to main portal: {MAIN_PORTAL_URL}")
-    page.goto(MAIN_PORTAL_URL, wait_until="domcontentloaded")
-    wait_page_ready(page, timeout_ms=30000)
 
-    # Validate Favorites button exists (stable)
-    fav_btn = page.locator('button[data-hrl-bo="atm-drowerButton"][aria-label="מועדפים"]').first
-    fav_btn.wait_for(state="attached", timeout=30000)
+    def _load(attempt_ms: int) -> None:
+        page.goto(MAIN_PORTAL_URL, wait_until="domcontentloaded", timeout=budget_ms(attempt_ms))
+        if LOGGED_OUT_URL_REGEX.search(page.url or ""):
+            raise RuntimeError(f"[Nav] Portal redirected to logout/login page: {page.url}")
+
+        # Validate Favorites button exists (stable)
+        fav_btn = page.locator(FAV_BUTTON_SELECTOR).first
+        fav_btn.wait_for(state="attached", timeout=budget_ms(attempt_ms))
+
+    run_with_adaptive_timeout("goto_main_portal", timeout_ms, _load)
     log.info("[Nav] Main portal loaded (Favorites button present).")
 
 
 # ----------------------------
 # Favorites (FIXED)
 # ----------------------------
+FAV_REPORT_LINK_ANY_SELECTOR = 'a[href*="DocIdLookup.aspx?DocId=AGENTS-31-129"], a:has-text("ריכוז תשלומים")'
+REPORT_READY_SELECTOR = "div.ctrlbutton.cbo"
+
+# Preferred order: stable href first, then the Hebrew titles ("דוח ריכוז תשלומים" on some sites)
+FAV_REPORT_LINK_STRATEGIES = [
+    LinkStrategy("href visible", href="DocIdLookup.aspx?DocId=AGENTS-31-129", visible=True),
+    LinkStrategy("href attached/hidden", href="DocIdLookup.aspx?DocId=AGENTS-31-129"),
+    LinkStrategy('text "ריכוז תשלומים" visible', text="ריכוז תשלומים", visible=True),
+    LinkStrategy('text "דוח ריכוז תשלומים" visible', text="דוח ריכוז תשלומים", visible=True),
+    LinkStrategy('text "ריכוז תשלומים" attached/hidden', text="ריכוז תשלומים"),
+    LinkStrategy('text "דוח ריכוז תשלומים" attached/hidden', text="דוח ריכוז תשלומים"),
+]
+
 def open_favorites(page) -> None:
     """
     Open Favorites drawer reliably.
     DO NOT use #navPanel (duplicated id).
     DO NOT wait for dynamic classes like agNav-jss440.
     """
-    wait_page_ready(page, timeout_ms=30000)
-    dismiss_overlays(page)
+    if not OVERLAY_AUTODISMISS:
+        dismiss_overlays(page)
 
-    fav_btn = page.locator('button[data-hrl-bo="atm-drowerButton"][aria-label="מועדפים"]').first
-    fav_btn.wait_for(state="attached", timeout=30000)
+    fav_btn = page.locator(FAV_BUTTON_SELECTOR).first
+    fav_btn.wait_for(state="attached", timeout=budget_ms(30000))
 
     # If already expanded, skip click
     try:
@@ -458,7 +1982,15 @@ def open_favorites(page) -> None:
     except Exception:
         pass
 
-    robust_click(page, locator=fav_btn, description="open Favorites (מועדפים)", timeout_ms=30000)
+    # Drawer is open once a report link is in the DOM (it often lives in an iframe)
+    robust_click(
+        page,
+        locator=fav_btn,
+        description="open Favorites (מועדפים)",
+        timeout_ms=30000,
+        expect=PostCondition.selector(FAV_REPORT_LINK_ANY_SELECTOR, any_frame=True),
+        toggle=True,
+    )
 
 
 def click_favorite_report_link(page) -> None:
@@ -468,57 +2000,240 @@ def click_favorite_report_link(page) -> None:
     FIX: don't rely on a.agNav-jss440.
     Strategy:
     - open favorites
-    - find by href (stable) across all frames
-    - fallback: find by text "ריכוז תשלומים" across all frames
+    - resolve href (stable) / text "ריכוז תשלומים" across all frames in one pass, best rank wins
     """
     open_favorites(page)
 
-    href_visible = 'a[href*="DocIdLookup.aspx?DocId=AGENTS-31-129"]:visible'
-    href_any = 'a[href*="DocIdLookup.aspx?DocId=AGENTS-31-129"]'
+    # Last run's winner goes first; a strategy whose click fails is dropped and the rest re-resolved
+    by_name = {st.name: st for st in FAV_REPORT_LINK_STRATEGIES}
+    remaining = [by_name[n] for n in order_strategies("fav_report_link", list(by_name))]
+    while True:
+        started = time.time()
+        hint = strategy_frame_hint("fav_report_link", remaining[0].name)
+        fr, loc, strategy = resolve_link_in_any_frame(page, remaining, timeout_ms=budget_ms(15000), frame_hint=hint)
+        if loc is None:
+            raise RuntimeError("Favorites report link not found (by href or text) in any frame.")
+        try:
+            href = urljoin(fr.url, loc.get_attribute("href", timeout=2000) or "")
+        except Exception:
+            href = ""
+        try:
+            robust_click(
+                page,
+                locator=loc,
+                description=f"click Favorites report ({strategy.name})",
+                timeout_ms=30000,
+                expect=PostCondition.selector(REPORT_READY_SELECTOR),
+            )
+        except BudgetExhausted:
+            raise
+        except Exception:
+            record_strategy("fav_report_link", strategy.name, False, (time.time() - started) * 1000)
+            remaining = [st for st in remaining if st is not strategy]
+            if not remaining:
+                raise
+            continue
+        record_strategy("fav_report_link", strategy.name, True, (time.time() - started) * 1000, frame=frame_key(fr))
+        break
 
-    # text fallbacks (some sites show "דוח ריכוז תשלומים", you asked "ריכוז תשלומים")
-    txt1_visible = 'a:has-text("ריכוז תשלומים"):visible'
-    txt1_any = 'a:has-text("ריכוז תשלומים")'
-    txt2_visible = 'a:has-text("דוח ריכוז תשלומים"):visible'
-    txt2_any = 'a:has-text("דוח ריכוז תשלומים")'
+    # Confirm report loaded
+    try:
+        page.wait_for_url(re.compile(r".*DocIdLookup\.aspx.*DocId=AGENTS-31-129.*"), timeout=budget_ms(30000))
+    except PWTimeout:
+        page.locator(REPORT_READY_SELECTOR).first.wait_for(state="attached", timeout=budget_ms(30000))
 
-    # 1) href visible
-    fr, loc = find_first_locator_in_any_frame(page, href_visible)
-    if loc:
-        robust_click_in_frame(page, fr, loc, "click Favorites report (href visible)", timeout_ms=30000)
-    else:
-        # 2) href attached/hidden
-        fr, loc = find_first_locator_in_any_frame(page, href_any)
-        if loc:
-            robust_click_in_frame(page, fr, loc, "click Favorites report (href attached/hidden)", timeout_ms=30000)
-        else:
-            # 3) text visible
-            fr, loc = find_first_locator_in_any_frame(page, txt1_visible)
-            if loc:
-                robust_click_in_frame(page, fr, loc, 'click Favorites report (text "ריכוז תשלומים" visible)', timeout_ms=30000)
-            else:
-                fr, loc = find_first_locator_in_any_frame(page, txt2_visible)
-                if loc:
-                    robust_click_in_frame(page, fr, loc, 'click Favorites report (text "דוח ריכוז תשלומים" visible)', timeout_ms=30000)
-                else:
-                    # 4) text attached/hidden
-                    fr, loc = find_first_locator_in_any_frame(page, txt1_any)
-                    if loc:
-                        robust_click_in_frame(page, fr, loc, 'click Favorites report (text "ריכוז תשלומים" attached/hidden)', timeout_ms=30000)
-                    else:
-                        fr, loc = find_first_locator_in_any_frame(page, txt2_any)
-                        if loc:
-                            robust_click_in_frame(page, fr, loc, 'click Favorites report (text "דוח ריכוז תשלומים" attached/hidden)', timeout_ms=30000)
-                        else:
-                            raise RuntimeError('Favorites report link not found (by href or text) in any frame.')
+    log.info("[Fav] Report opened successfully (AGENTS-31-129).")
+    remember_report_url(href)
 
-    # Confirm report loaded
+
+REPORT_LINKS_FILE = "report_links.json"
+REPORT_LINK_KEY = "AGENTS-31-129"
+
+
+def remember_report_url(href: str) -> None:
+    if not href.lower().startswith(("http://", "https://")):
+        return
+    links = load_json_state(REPORT_LINKS_FILE, {})
+    if (links.get(REPORT_LINK_KEY) or {}).get("url") == href:
+        return
+    links[REPORT_LINK_KEY] = {"url": href, "learned_at": datetime.now().isoformat(timespec="seconds")}
+    save_json_state(REPORT_LINKS_FILE, links)
+    log.info(f"[Fav] Learned report deep link: {href}")
+
+
+def forget_report_url() -> None:
+    links = load_json_state(REPORT_LINKS_FILE, {})
+    if links.pop(REPORT_LINK_KEY, None) is not None:
+        save_json_state(REPORT_LINKS_FILE, links)
+
+
+def open_report_via_deep_link(page) -> bool:
+    """
+    Fast path: goto the cached report URL and wait for the report controls.
+    False (and the cached URL dropped) if there is none or the report doesn't render; the caller then
+    takes the Favorites path, which learns the URL again. A logout redirect is the session's fault,
+    so the URL is kept.
+    """
+    if not REPORT_DEEP_LINK:
+        return False
+    url = (load_json_state(REPORT_LINKS_FILE, {}).get(REPORT_LINK_KEY) or {}).get("url")
+    if not url:
+        return False
+    log.info(f"[Fav] Opening report via deep link: {url}")
     try:
-        page.wait_for_url(re.compile(r".*DocIdLookup\.aspx.*DocId=AGENTS-31-129.*"), timeout=30000)
+        page.goto(url, wait_until="domcontentloaded", timeout=budget_ms(REPORT_DEEP_LINK_TIMEOUT_MS))
+        if LOGGED_OUT_URL_REGEX.search(page.url or ""):
+            log.info(f"[Fav] Deep link redirected to {page.url} (session expired)")
+            return False
+        page.locator(REPORT_READY_SELECTOR).first.wait_for(
+            state="attached", timeout=budget_ms(REPORT_DEEP_LINK_TIMEOUT_MS)
+        )
+    except BudgetExhausted:
+        raise
+    except Exception as e:
+        log.warning(f"[Fav] Deep link failed ({e}); falling back to Favorites")
+        forget_report_url()
+        return False
+    log.info("[Fav] Report opened via deep link (AGENTS-31-129).")
+    return True
+
+
+def open_report_or_portal(page, portal_timeout_ms: int = 30000) -> bool:
+    """
+    Land a logged-in page where the flow goes next, which also validates the session:
+    the cached report deep link (True) or, without one, MAIN_PORTAL_URL (False).
+    Raises if the portal rejects the session.
+    """
+    if open_report_via_deep_link(page):
+        return True
+    if LOGGED_OUT_URL_REGEX.search(page.url or ""):
+        raise RuntimeError(f"[Nav] Deep link redirected to logout/login page: {page.url}")
+    goto_main_portal(page, timeout_ms=portal_timeout_ms)
+    return False
+
+
+# ----------------------------
+# Excel export replay (skip the paid.aspx UI)
+# ----------------------------
+EXPORT_REQUEST_FILE = "export_request.json"
+HIDDEN_INPUT_RE = re.compile(r"<input\b[^>]*\btype=[\"']hidden[\"'][^>]*>", re.IGNORECASE)
+ATTR_RE = re.compile(r"""\b(name|value)\s*=\s*(?:"([^"]*)"|'([^']*)')""", re.IGNORECASE)
+CONTENT_DISPOSITION_FILENAME_RE = re.compile(r"""filename\*?\s*=\s*(?:UTF-8'')?"?([^";]+)"?""", re.IGNORECASE)
+SPREADSHEET_SIGNATURES = (b"PK\x03\x04", b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1")  # XLSX (zip), XLS (OLE2)
+
+
+def _hidden_fields(page_html: str) -> Dict[str, str]:
+    fields: Dict[str, str] = {}
+    for tag in HIDDEN_INPUT_RE.findall(page_html):
+        attrs = {m.group(1).lower(): m.group(2) if m.group(2) is not None else m.group(3) for m in ATTR_RE.finditer(tag)}
+        if attrs.get("name"):
+            fields[attrs["name"]] = html.unescape(attrs.get("value") or "")
+    return fields
+
+
+def remember_export_request(paid_page, download, requests_seen: Sequence[Any]) -> None:
+    """Keep the request that produced `download` (URL, method, form body) for the next run's replay."""
+    req = next((r for r in reversed(requests_seen) if r.url == download.url), None)
+    if req is None:
+        return
+    paid_url = paid_page.url
+    try:
+        with open(download.path(), "rb") as f:
+            magic = f.read(8)
     except Exception:
-        page.locator("div.ctrlbutton.cbo").first.wait_for(state="attached", timeout=30000)
+        magic = b""
+    save_json_state(EXPORT_REQUEST_FILE, {
+        "url": req.url,
+        "posts_to_paid_page": req.url == paid_url,  # ASP.NET postback to itself -> replay against today's paid URL
+        "method": req.method,
+        "content_type": req.headers.get("content-type", ""),
+        "post_data": req.post_data or "",
+        "suggested_filename": download.suggested_filename,
+        "magic": magic.hex(),  # first bytes of the real export: a replayed body must start the same way
+        "captured_at": datetime.now().isoformat(timespec="seconds"),
+    })
+    log.info(f"[Export] Captured Excel export request: {req.method} {req.url}")
+
+
+def _replay_session(paid_page) -> requests.Session:
+    sess = requests.Session()
+    for c in paid_page.context.cookies():
+        sess.cookies.set(c["name"], c["value"], domain=c.get("domain", ""), path=c.get("path", "/"))
+    sess.headers["User-Agent"] = paid_page.evaluate("navigator.userAgent")
+    sess.headers["Referer"] = paid_page.url
+    return sess
+
+
+def _looks_like_export(head: bytes, cap: Dict[str, Any]) -> bool:
+    """A spreadsheet signature, or the same leading bytes as the file the UI downloaded when capturing."""
+    if head.startswith(SPREADSHEET_SIGNATURES):
+        return True
+    magic = bytes.fromhex(cap.get("magic") or "")[:4]
+    return bool(magic) and head.startswith(magic)
+
+
+def replay_excel_export(paid_page, download_dir: Path) -> Optional[Path]:
+    """
+    Re-send the captured export with the browser's cookies: GET the paid page for fresh
+    __VIEWSTATE/__EVENTVALIDATION, POST the captured form with those swapped in, stream the file.
+    None (capture dropped) when anything looks wrong -> the caller takes the UI path and re-captures.
+    """
+    if not EXPORT_REPLAY:
+        return None
+    cap = load_json_state(EXPORT_REQUEST_FILE, None)
+    if not cap:
+        return None
 
-    log.info("[Fav] Report opened successfully (AGENTS-31-129).")
+    started = time.time()
+    target_url = paid_page.url if cap.get("posts_to_paid_page") else cap["url"]
+    tmp: Optional[Path] = None
+    try:
+        sess = _replay_session(paid_page)
+        timeout = budget_ms(EXPORT_REPLAY_TIMEOUT_SECONDS * 1000) / 1000.0
+        if cap["method"].upper() == "POST":
+            body = cap.get("post_data") or ""
+            if "x-www-form-urlencoded" in (cap.get("content_type") or ""):
+                page_resp = sess.get(paid_page.url, timeout=timeout)
+                page_resp.raise_for_status()
+                # ASP.NET state only; __EVENTTARGET/__EVENTARGUMENT are what makes this the export postback
+                fresh = {k: v for k, v in _hidden_fields(page_resp.text).items()
+                         if k.startswith("__") and k not in ("__EVENTTARGET", "__EVENTARGUMENT")}
+                body = urlencode([(k, fresh.get(k, v)) for k, v in parse_qsl(body, keep_blank_values=True)])
+            resp = sess.post(target_url, data=body, headers={"Content-Type": cap.get("content_type") or ""},
+                             timeout=timeout, stream=True)
+        else:
+            resp = sess.get(target_url, timeout=timeout, stream=True)
+
+        with resp:
+            ctype = resp.headers.get("Content-Type", "")
+            if resp.status_code != 200 or "text/html" in ctype.lower():
+                raise RuntimeError(f"HTTP {resp.status_code} {ctype or '(no content type)'}")
+            m = CONTENT_DISPOSITION_FILENAME_RE.search(resp.headers.get("Content-Disposition", ""))
+            filename = Path(unquote(m.group(1)).strip() if m else cap.get("suggested_filename") or "export.xlsx").name
+            target = download_dir / filename
+            tmp = target.with_name(target.name + ".part")
+            size = 0
+            with open(tmp, "wb") as f:
+                for chunk in resp.iter_content(chunk_size=64 * 1024):
+                    # an error or login page served as text/plain / octet-stream is not the report
+                    if size == 0 and not _looks_like_export(chunk, cap):
+                        raise RuntimeError(f"{ctype or '(no content type)'} body is not a spreadsheet: {chunk[:16]!r}")
+                    f.write(chunk)
+                    size += len(chunk)
+        if size == 0:
+            raise RuntimeError("empty response body")
+        os.replace(tmp, target)
+    except BudgetExhausted:
+        raise
+    except Exception as e:
+        log.warning(f"[Export] Replay failed ({e}); falling back to the paid.aspx UI")
+        if tmp is not None:
+            tmp.unlink(missing_ok=True)
+        save_json_state(EXPORT_REQUEST_FILE, None)
+        return None
+
+    log.info(f"[Export] Excel replayed over HTTP in {(time.time() - started) * 1000:.0f} ms ({size} bytes): {target}")
+    return target
 
 
 # ----------------------------
@@ -526,29 +2241,74 @@ def click_favorite_report_link(page) -> None:
 # ----------------------------
 def handle_paid_window_and_download(paid_page, download_dir: Path) -> Path:
     log.info("[Paid] Handling paid.aspx window...")
-    wait_page_ready(paid_page, timeout_ms=25000)
+    run_with_adaptive_timeout(
+        "paid:load", 25000, lambda ms: paid_page.wait_for_load_state("domcontentloaded", timeout=budget_ms(ms))
+    )
 
-    robust_click(paid_page, selector="div.ctrlbutton.cbo", description="paid dropdown", timeout_ms=25000)
+    replayed = replay_excel_export(paid_page, download_dir)
+    if replayed is not None:
+        return replayed
 
     sel_all = paid_page.locator('div.selectall[role="button"]').filter(has_text="בחר הכל").first
-    robust_click(paid_page, locator=sel_all, description='paid "בחר הכל"', timeout_ms=25000)
+    robust_click(
+        paid_page,
+        selector=REPORT_READY_SELECTOR,
+        description="paid dropdown",
+        timeout_ms=25000,
+        expect=PostCondition.locator(sel_all, state="visible"),
+        toggle=True,
+    )
+    robust_click(
+        paid_page,
+        locator=sel_all,
+        description='paid "בחר הכל"',
+        timeout_ms=25000,
+        expect=[PostCondition.response(is_postback_response, required=False), PostCondition.quiet()],
+    )
 
-    try:
-        btn = paid_page.get_by_role("button", name=re.compile(r"^\s*סנן מידע\s*$"))
-        robust_click(paid_page, locator=btn, description='paid "סנן מידע"', timeout_ms=25000)
-    except Exception:
-        robust_click(paid_page, selector="button.filter-apply", description='paid "סנן מידע" (fallback)', timeout_ms=25000)
+    # Filter is done when the server answered the postback and the Excel button is there
+    excel_btn = paid_page.locator("button.bar-excel").first
+    filtered = [
+        PostCondition.response(is_postback_response, required=False),
+        PostCondition.quiet(),  # the postback's follow-up requests (grid/partial refresh) have landed
+        PostCondition.locator(excel_btn, state="attached"),
+    ]
+    filter_buttons = {
+        "role": ('paid "סנן מידע"', paid_page.get_by_role("button", name=re.compile(r"^\s*סנן מידע\s*$"))),
+        "css": ('paid "סנן מידע" (fallback)', paid_page.locator("button.filter-apply").first),
+    }
+    for i, name in enumerate(order_strategies("paid_filter", list(filter_buttons))):
+        description, btn = filter_buttons[name]
+        started = time.time()
+        try:
+            robust_click(paid_page, locator=btn, description=description, timeout_ms=25000, expect=filtered)
+        except BudgetExhausted:
+            raise
+        except Exception:
+            record_strategy("paid_filter", name, False, (time.time() - started) * 1000)
+            if i == len(filter_buttons) - 1:
+                raise
+            continue
+        record_strategy("paid_filter", name, True, (time.time() - started) * 1000)
+        break
 
-    time.sleep(1.5)
-    wait_page_ready(paid_page, timeout_ms=25000)
+    # Watch the requests of the Excel click so the export can be replayed over HTTP next time
+    export_requests: List[Any] = []
 
-    excel_btn = paid_page.locator("button.bar-excel").first
-    excel_btn.wait_for(state="attached", timeout=25000)
+    def _record(request) -> None:
+        export_requests.append(request)
 
-    with paid_page.expect_download(timeout=60000) as d:
-        robust_click(paid_page, locator=excel_btn, description="paid Excel download", timeout_ms=25000)
+    # Fixed ceiling, not a learned one: the export is slow on some days and a retry would click Excel again
+    paid_page.on("request", _record)
+    try:
+        with paid_page.expect_download(timeout=budget_ms(60000)) as d:
+            robust_click(paid_page, locator=excel_btn, description="paid Excel download", timeout_ms=25000)
+    finally:
+        paid_page.remove_listener("request", _record)
 
     dl = d.value
+    if EXPORT_REPLAY:
+        remember_export_request(paid_page, dl, export_requests)
     target = download_dir / dl.suggested_filename
     dl.save_as(str(target))
     log.info(f"[Paid] Excel saved to: {target}")
@@ -566,85 +2326,308 @@ def _parse_il_date_ddmmyyyy(s: str) -> Optional[datetime]:
         return None
 
 
-def run_payments_assembly_flow(page, download_dir: Path) -> None:
-    log.info("[Post] Starting payments assembly flow...")
+# Every row that has data_colid cells -> {colid: text}; rows are tagged so the chosen one
+# can be addressed afterwards without another scan.
+EXTRACT_GRID_JS = r"""
+(token) => {
+  const rows = [];
+  document.querySelectorAll('tr').forEach((tr) => {
+    const tds = tr.querySelectorAll(':scope > td[data_colid]');
+    if (!tds.length) return;
+    const cells = {};
+    tds.forEach((td) => { cells[td.getAttribute('data_colid')] = (td.innerText || '').trim(); });
+    tr.setAttribute('data-harel-bot-row', token + '-' + rows.length);
+    rows.push(cells);
+  });
+  return rows;
+}
+"""
 
-    # IMPORTANT: go to correct portal page first
-    goto_main_portal(page)
+_GRID_SEQ = itertools.count(1)
 
-    # Favorites -> report (FIXED)
-    click_favorite_report_link(page)
 
-    # Company dropdown
-    robust_click(page, selector="div.ctrlbutton.cbo", description="company dropdown", timeout_ms=25000)
+@dataclass
+class GridRow:
+    index: int
+    cells: Dict[str, str]
+    token: str
 
-    company_regex = re.compile(r"^113005565\s+-\s+ידידים")
-    company_btn = page.get_by_role("button", name=company_regex)
-    robust_click(page, locator=company_btn, description="select company 113005565", timeout_ms=25000)
+    def locator(self, page):
+        return page.locator(f'tr[data-harel-bot-row="{self.token}-{self.index}"]').first
 
-    # Filter
-    filter_btn = page.get_by_role("button", name=re.compile(r"^\s*סנן מידע\s*$"))
-    robust_click(page, locator=filter_btn, description='click "סנן מידע"', timeout_ms=25000)
 
-    time.sleep(1.2)
-    wait_page_ready(page, timeout_ms=25000)
+def extract_grid_rows(page) -> List[GridRow]:
+    """All grid rows in one evaluate."""
+    token = f"grid-{next(_GRID_SEQ)}"
+    data = page.evaluate(EXTRACT_GRID_JS, token) or []
+    return [GridRow(index=i, cells=cells, token=token) for i, cells in enumerate(data)]
+
+
+def pick_latest_row(rows: Sequence[GridRow], col: str = "Date_Hatama_Desc") -> Tuple[Optional[GridRow], datetime]:
+    best_row, best_dt = None, datetime.min
+    for row in rows:
+        m = re.search(r"(\d{2}/\d{2}/\d{4})", row.cells.get(col, ""))
+        dt = _parse_il_date_ddmmyyyy(m.group(1)) if m else None
+        if dt and dt > best_dt:
+            best_row, best_dt = row, dt
+    return best_row, best_dt
+
+
+# ---- grid rows from the filter response (JSON or HTML / UpdatePanel delta) ----
+GRID_RESPONSE_TYPES = ("xhr", "fetch", "document")
+GRID_ROW_RE = re.compile(r"<tr\b[^>]*>(.*?)</tr>", re.IGNORECASE | re.DOTALL)
+GRID_CELL_RE = re.compile(r"""<td\b[^>]*\bdata_colid=["']([^"']+)["'][^>]*>(.*?)</td>""", re.IGNORECASE | re.DOTALL)
+TAG_RE = re.compile(r"<[^>]+>")
+
+
+def _parse_amount(s: str) -> Optional[float]:
+    s = (s or "").strip()
+    negative = (s.startswith("(") and s.endswith(")")) or "-" in s
+    digits = re.sub(r"[^\d.]", "", s.replace(",", ""))
+    try:
+        value = float(digits)
+    except ValueError:
+        return None
+    return -value if negative else value
 
-    # Find latest date row via TR
-    log.info('[Post] Finding latest "תאריך פעולה" row...')
-    date_cells = page.locator('td[data_colid="Date_Hatama_Desc"]')
-    date_cells.first.wait_for(state="attached", timeout=25000)
 
-    best_cell = None
-    best_dt = datetime.min
-    for i in range(date_cells.count()):
-        cell = date_cells.nth(i)
+def _parse_grid_date(s: str) -> Optional[datetime]:
+    s = s or ""
+    m = re.search(r"(\d{2}/\d{2}/\d{4})", s)
+    if m:
+        return _parse_il_date_ddmmyyyy(m.group(1))
+    m = re.search(r"/Date\((-?\d+)", s)  # ASP.NET JSON date
+    if m:
+        return datetime.fromtimestamp(int(m.group(1)) / 1000.0)
+    m = re.search(r"(\d{4}-\d{2}-\d{2})", s)
+    if m:
+        return datetime.strptime(m.group(1), "%Y-%m-%d")
+    return None
+
+
+@dataclass
+class PaymentRow:
+    date: Optional[datetime]
+    sochen_id: str
+    schum_nifraim: Optional[float]
+    m2_schum: Optional[float]
+    cells: Dict[str, str]
+
+    @classmethod
+    def from_cells(cls, cells: Dict[str, str]) -> "PaymentRow":
+        agent = re.search(r"\d+", cells.get("Sochen_ID", ""))
+        return cls(
+            date=_parse_grid_date(cells.get("Date_Hatama_Desc", "")),
+            sochen_id=agent.group(0) if agent else "",
+            schum_nifraim=_parse_amount(cells.get("Schum_Nifraim", "")),
+            m2_schum=_parse_amount(cells.get("_M2_Schum", "")),
+            cells=cells,
+        )
+
+
+def _rows_from_json(obj: Any) -> List[Dict[str, str]]:
+    """First list of records carrying Date_Hatama_Desc, anywhere in the payload."""
+    if isinstance(obj, str):
+        if obj.lstrip()[:1] in ("{", "["):  # {"d": "<json string>"} style wrappers
+            try:
+                return _rows_from_json(json.loads(obj))
+            except ValueError:
+                return []
+        return []
+    if isinstance(obj, list) and any(isinstance(x, dict) and "Date_Hatama_Desc" in x for x in obj):
+        return [{k: "" if v is None else str(v) for k, v in x.items()} for x in obj if isinstance(x, dict)]
+    children = obj.values() if isinstance(obj, dict) else obj if isinstance(obj, list) else []
+    for child in children:
+        rows = _rows_from_json(child)
+        if rows:
+            return rows
+    return []
+
+
+def _rows_from_html(text: str) -> List[Dict[str, str]]:
+    rows = []
+    for tr in GRID_ROW_RE.findall(text):
+        cells = {
+            colid: re.sub(r"\s+", " ", html.unescape(TAG_RE.sub(" ", inner))).strip()
+            for colid, inner in GRID_CELL_RE.findall(tr)
+        }
+        if "Date_Hatama_Desc" in cells:
+            rows.append(cells)
+    return rows
+
+
+def grid_rows_from_responses(responses: Sequence[Any]) -> List[PaymentRow]:
+    """Newest response that carries grid rows wins."""
+    for resp in reversed(responses):
         try:
-            txt = (cell.inner_text() or "").strip()
+            ctype = (resp.headers.get("content-type") or "").lower()
+            if not any(t in ctype for t in ("json", "html", "text/plain")):
+                continue
+            text = resp.text()
         except Exception:
-            continue
-        m = re.search(r"(\d{2}/\d{2}/\d{4})", txt)
-        if not m:
-            continue
-        dt = _parse_il_date_ddmmyyyy(m.group(1))
-        if dt and dt > best_dt:
-            best_dt = dt
-            best_cell = cell
+            continue  # redirect / body gone
+        if "json" in ctype or text.lstrip()[:1] in ("{", "["):
+            try:
+                raw = _rows_from_json(json.loads(text))
+            except ValueError:
+                raw = []
+        else:
+            raw = _rows_from_html(text) if "data_colid" in text else []
+        if raw:
+            log.info(f"[Post] Grid data from response: {len(raw)} rows ({resp.request.method} {resp.url})")
+            return [PaymentRow.from_cells(c) for c in raw]
+    return []
+
+
+def locate_grid_row(page, row: PaymentRow, timeout_ms: int = 3000):
+    """DOM <tr> showing this row (same date and agent), for the clicks."""
+    xp = (
+        '//tr[td[@data_colid="Date_Hatama_Desc"]'
+        f'[contains(normalize-space(.), "{row.date.strftime("%d/%m/%Y")}")]]'
+    )
+    if row.sochen_id:
+        xp += f'[td[@data_colid="Sochen_ID"][contains(normalize-space(.), "{row.sochen_id}")]]'
+    loc = page.locator(f"xpath={xp}").first
+    loc.wait_for(state="attached", timeout=budget_ms(timeout_ms))
+    return loc
 
-    if best_cell is None:
+
+def find_latest_grid_row(page, grid_responses: Sequence[Any]) -> Tuple[Any, PaymentRow]:
+    """
+    Latest "תאריך פעולה" row: from the intercepted filter response when possible (no DOM reads),
+    otherwise the whole DOM grid in one evaluate. Returns (row locator, typed row).
+    """
+    if GRID_FROM_RESPONSE:
+        rows = [r for r in grid_rows_from_responses(grid_responses) if r.date]
+        if rows:
+            latest = max(rows, key=lambda r: r.date)
+            try:
+                return locate_grid_row(page, latest), latest
+            except BudgetExhausted:
+                raise
+            except Exception as e:
+                log.info(f"[Post] Row from response not found in the DOM ({e}); reading the DOM grid")
+
+    rows = extract_grid_rows(page)
+    picked, _ = pick_latest_row(rows)
+    if picked is None:
         raise RuntimeError('Could not parse any dd/mm/yyyy from "תאריך פעולה" cells.')
+    log.info(f"[Post] Grid data from DOM: {len(rows)} rows")
+    return picked.locator(page), PaymentRow.from_cells(picked.cells)
+
+
+def run_payments_assembly_flow(
+    page, download_dir: Path, portal_ready: bool = False, report_ready: bool = False
+) -> None:
+    """
+    portal_ready / report_ready: the caller already landed the page via open_report_or_portal
+    (which tried the deep link) and it is on the portal / on the report.
+    """
+    log.info("[Post] Starting payments assembly flow...")
+
+    # Deep link straight to the report; otherwise portal -> Favorites -> report (FIXED)
+    with budget_step("report"):
+        if report_ready:
+            log.info("[Fav] Report already open (session validated on its deep link)")
+        elif portal_ready:
+            click_favorite_report_link(page)
+        elif not open_report_via_deep_link(page):
+            # IMPORTANT: go to correct portal page first
+            goto_main_portal(page)
+            click_favorite_report_link(page)
+
+    with budget_step("grid"):
+        paid_page = open_latest_paid_popup(page)
+
+    with budget_step("download"):
+        saved_excel = handle_paid_window_and_download(paid_page, download_dir)
+    log.info(f"[Post] Paid Excel downloaded: {saved_excel}")
+    log.info("[Post] Payments assembly flow done ✅")
+
+
+def open_latest_paid_popup(page):
+    """Company -> filter -> latest row -> נפרעים -> month cell; returns the paid.aspx popup page."""
+    # Company dropdown
+    company_regex = re.compile(r"^113005565\s+-\s+ידידים")
+    company_btn = page.get_by_role("button", name=company_regex)
+    robust_click(
+        page,
+        selector=REPORT_READY_SELECTOR,
+        description="company dropdown",
+        timeout_ms=25000,
+        expect=PostCondition.locator(company_btn, state="visible"),
+        toggle=True,
+    )
+    robust_click(
+        page,
+        locator=company_btn,
+        description="select company 113005565",
+        timeout_ms=25000,
+        expect=[PostCondition.response(is_postback_response, required=False), PostCondition.quiet()],
+    )
+
+    # Filter: done when the server answered and the grid has date cells.
+    # The answer itself is kept: it already holds the rows we'd otherwise read back from the DOM.
+    date_cells = page.locator('td[data_colid="Date_Hatama_Desc"]')
+    filter_btn = page.get_by_role("button", name=re.compile(r"^\s*סנן מידע\s*$"))
+    grid_responses: List[Any] = []
+
+    def _record(response) -> None:
+        if response.request.resource_type in GRID_RESPONSE_TYPES:
+            grid_responses.append(response)
 
-    log.info(f"[Post] Latest date found: {best_dt.strftime('%d/%m/%Y')}")
-    row = best_cell.locator("xpath=ancestor::tr[1]")
+    page.on("response", _record)
+    try:
+        robust_click(
+            page,
+            locator=filter_btn,
+            description='click "סנן מידע"',
+            timeout_ms=25000,
+            expect=[
+                PostCondition.response(is_postback_response, required=False),
+                # without it, date cells of the pre-filter grid would already satisfy the next condition
+                PostCondition.quiet(),
+                PostCondition.locator(date_cells.first, state="attached"),
+            ],
+        )
+    finally:
+        page.remove_listener("response", _record)
+
+    log.info('[Post] Finding latest "תאריך פעולה" row...')
+    row, latest = find_latest_grid_row(page, grid_responses)
+    log.info(
+        f"[Post] Latest date found: {latest.date.strftime('%d/%m/%Y')} "
+        f"(נפרעים={latest.schum_nifraim}, month={latest.m2_schum})"
+    )
+
+    # Validate agent number (already extracted; fail before clicking anything)
+    if latest.sochen_id != "165":
+        raise RuntimeError(f"[Post] Agent number mismatch: expected 165, got '{latest.cells.get('Sochen_ID', '')}'")
+    log.info("[Post] Agent number OK (165).")
 
     # Click "נפרעים"
     nifraim = row.locator('td[data_colid="Schum_Nifraim"] span').first
-    robust_click(page, locator=nifraim, description='click "נפרעים" (latest row)', timeout_ms=25000)
-
-    # Validate agent number
-    agent_cell = row.locator('td[data_colid="Sochen_ID"]').first
-    agent_text = (agent_cell.inner_text() or "").strip()
-    agent_digits = re.search(r"\d+", agent_text)
-    agent_num = agent_digits.group(0) if agent_digits else ""
-    if agent_num != "165":
-        raise RuntimeError(f"[Post] Agent number mismatch: expected 165, got '{agent_text}'")
-    log.info("[Post] Agent number OK (165).")
+    robust_click(
+        page,
+        locator=nifraim,
+        description='click "נפרעים" (latest row)',
+        timeout_ms=25000,
+        expect=[PostCondition.response(is_postback_response, required=False), PostCondition.quiet()],
+    )
 
-    # Click month amount -> popup
+    # Click month amount -> popup. Re-find the row by its content: a grid re-render drops the DOM tag.
+    row = locate_grid_row(page, latest, timeout_ms=25000)
     month_span = row.locator('td[data_colid="_M2_Schum"] span').first
-    month_span.wait_for(state="attached", timeout=25000)
+    month_span.wait_for(state="attached", timeout=budget_ms(25000))
     try:
-        month_span.scroll_into_view_if_needed(timeout=25000)
-    except Exception:
+        month_span.scroll_into_view_if_needed(timeout=budget_ms(25000))
+    except PWTimeout:
         pass
 
     ctx = page.context
-    with ctx.expect_page(timeout=25000) as pop:
+    with ctx.expect_page(timeout=budget_ms(25000)) as pop:
         robust_click(page, locator=month_span, description="open paid popup (month cell)", timeout_ms=25000)
-    paid_page = pop.value
-
-    saved_excel = handle_paid_window_and_download(paid_page, download_dir)
-    log.info(f"[Post] Paid Excel downloaded: {saved_excel}")
-    log.info("[Post] Payments assembly flow done ✅")
+    return pop.value
 
 
 # ----------------------------
@@ -655,26 +2638,58 @@ def click_reconnect_link_if_present(page) -> None:
     try:
         link = page.locator('a[href="/"]').first
         if link.count() > 0 and link.is_visible(timeout=2000):
-            robust_click(page, locator=link, description="reconnect link", timeout_ms=12000)
+            robust_click(
+                page,
+                locator=link,
+                description="reconnect link",
+                timeout_ms=12000,
+                expect=PostCondition.selector("#input_1"),
+            )
     except Exception:
         pass
 
 
 def fill_login_credentials(page, username: str, password: str) -> None:
     log.info("[Step 2] Filling login credentials...")
-    page.wait_for_selector("#input_1", timeout=20000)
+    page.wait_for_selector("#input_1", timeout=budget_ms(20000))
     page.fill("#input_1", username)
     page.fill("#input_2", password)
     log.info("[Step 2] Credentials filled")
 
 
-def click_submit_button(page) -> None:
+def click_submit_button(page, otp_input: str = "") -> None:
     log.info("[Step 3] Clicking submit button...")
     submit = page.locator('input.credentials_input_submit[value="אישור"]').first
-    robust_click(page, locator=submit, description='submit login ("אישור")', timeout_ms=20000)
+    # Done on the OTP screen (still my.policy) or once redirected past the APM pages.
+    # Clicked once: every submit sends a new SMS.
+    left_login = PostCondition.url(lambda url: not LOGGED_OUT_URL_REGEX.search(url))
+    robust_click(
+        page,
+        locator=submit,
+        description='submit login ("אישור")',
+        timeout_ms=20000,
+        expect=PostCondition.any_of(PostCondition.selector(otp_input), left_login) if otp_input else left_login,
+        retries=1,
+    )
 
 
-def maybe_handle_otp(page, selectors: Dict[str, str]) -> None:
+def resolve_otp_checkpoint(checkpoint: "Optional[Future[datetime]]") -> Optional[datetime]:
+    if checkpoint is None:
+        return None
+    try:
+        return checkpoint.result()
+    except Exception as e:
+        log.warning(f"[Step 3] Could not take Pulseem checkpoint: {e}")
+        return None
+
+
+def maybe_handle_otp(
+    page,
+    selectors: Dict[str, str],
+    checkpoint_dt: Optional[datetime] = None,
+    submitted_at: Optional[float] = None,
+    har_otp_file: str = "",
+) -> None:
     otp_input = selectors.get("otp_input") or ""
     otp_submit = selectors.get("otp_submit") or ""
     if not otp_input or not otp_submit:
@@ -683,45 +2698,69 @@ def maybe_handle_otp(page, selectors: Dict[str, str]) -> None:
 
     log.info("[Step 4] Checking for OTP screen...")
     try:
-        page.wait_for_selector(otp_input, timeout=7000)
+        page.wait_for_selector(otp_input, timeout=budget_ms(7000))
         log.info("[Step 4] OTP screen detected!")
     except PWTimeout:
         log.info("[Step 4] No OTP screen detected, continuing...")
         return
 
-    log.info(f"[Step 4] Waiting {OTP_INITIAL_DELAY_SECONDS}s for SMS to be sent...")
-    time.sleep(OTP_INITIAL_DELAY_SECONDS)
+    submitted_at = submitted_at or time.time()
+    schedule = OtpPollSchedule(started_at=submitted_at)
+    checkpoint_dt = checkpoint_dt or datetime.min
+    log.info(f"[Step 4] Checkpoint last SMS: {checkpoint_dt.isoformat() if checkpoint_dt != datetime.min else 'None'}")
+    log.info(f"[Step 4] SMS usually arrives ~{schedule.expected_arrival:.1f}s after submit")
+
+    broker = OtpBroker(budget_ms(OTP_OVERALL_DEADLINE_SECONDS * 1000) / 1000.0)
+    if HAR_REPLAY:
+        # offline replay: route_from_har matches POST bodies exactly, so submit the code that was recorded
+        replay_otp = HAR_REPLAY_OTP
+        if not replay_otp and har_otp_file and Path(har_otp_file).exists():
+            replay_otp = Path(har_otp_file).read_text(encoding="utf-8").strip()
+        if not replay_otp:
+            raise RuntimeError(f"No recorded OTP at {har_otp_file} - record the HAR again or set HAR_REPLAY_OTP")
+        drop_file = None
+        broker.add("har-replay", lambda stop: (replay_otp, {}))
+    else:
+        try:
+            auth = build_pulseem_auth_from_env()
+            broker.add(
+                "pulseem",
+                lambda stop: wait_for_otp_from_pulseem(
+                    virtual_number=PULSEEM_VIRTUAL_NUMBER,
+                    auth=auth,
+                    after_datetime=checkpoint_dt,
+                    lookback_seconds=OTP_LOOKBACK_SECONDS,
+                    max_wait_seconds=OTP_MAX_WAIT_SECONDS,
+                    poll_every_seconds=OTP_POLL_SECONDS,
+                    schedule=schedule,
+                    stop_event=stop,
+                ),
+            )
+        except Exception as e:
+            log.warning(f"[Step 4] Pulseem OTP unavailable: {e}")
+            if not MANUAL_OTP_FALLBACK:
+                raise
+
+        receiver = get_otp_webhook_receiver()
+        if receiver is not None:
+            broker.add("http", receiver.source)
 
-    otp: Optional[str] = None
-    try:
-        auth = build_pulseem_auth_from_env()
-        checkpoint_dt = get_last_sms_datetime(PULSEEM_VIRTUAL_NUMBER, auth, lookback_seconds=600)
-        log.info(f"[Step 4] Checkpoint last SMS: {checkpoint_dt.isoformat() if checkpoint_dt != datetime.min else 'None'}")
-
-        otp, msg = wait_for_otp_from_pulseem(
-            virtual_number=PULSEEM_VIRTUAL_NUMBER,
-            auth=auth,
-            after_datetime=checkpoint_dt,
-            lookback_seconds=OTP_LOOKBACK_SECONDS,
-            max_wait_seconds=OTP_MAX_WAIT_SECONDS,
-            poll_every_seconds=OTP_POLL_SECONDS,
-        )
-        log.info(f"[Step 4] Received OTP from Pulseem (ReplyDate={msg.get('ReplyDate') if msg else None})")
-    except Exception as e:
-        log.warning(f"[Step 4] Pulseem OTP failed: {e}")
-        if not MANUAL_OTP_FALLBACK:
-            raise
+        drop_file = otp_drop_file_path()
+        broker.add("drop-file", lambda stop: drop_file_otp_source(stop, drop_file, armed_at=submitted_at))
 
-        log.info("[Step 4] Manual OTP fallback ENABLED.")
-        start = time.time()
-        manual = ""
-        while time.time() - start < MANUAL_OTP_MAX_WAIT_SECONDS:
-            manual = input("Enter OTP code: ").strip()
-            if manual:
-                break
-        if not manual:
-            raise TimeoutError("Manual OTP entry timed out / empty input.")
-        otp = manual
+        if MANUAL_OTP_FALLBACK and sys.stdin is not None and sys.stdin.isatty():
+            broker.add("console", console_otp_source)
+
+    log.info(
+        f"[Step 4] Waiting up to {broker.deadline - time.time():.0f}s for the first OTP from: {', '.join(broker.names)} "
+        f"(drop file: {drop_file})"
+    )
+    winner, (otp, msg) = broker.wait()
+    elapsed = time.time() - submitted_at
+    if msg.get("ReplyText"):
+        # only real SMS deliveries feed the arrival-time history
+        OtpPollSchedule.record_arrival(elapsed)
+    log.info(f"[Step 4] Received OTP via {winner} {elapsed:.1f}s after submit (ReplyDate={msg.get('ReplyDate')})")
 
     if not otp:
         raise RuntimeError("OTP is empty - cannot continue.")
@@ -729,9 +2768,195 @@ def maybe_handle_otp(page, selectors: Dict[str, str]) -> None:
     page.fill(otp_input, "")
     page.fill(otp_input, otp)
     log.info("[Step 4] OTP entered")
+    if har_otp_file and not HAR_REPLAY:
+        Path(har_otp_file).write_text(otp, encoding="utf-8")
+        log.info(f"[HAR] Saved the entered OTP for replay: {har_otp_file}")
 
     submit = page.locator(otp_submit).first
-    robust_click(page, locator=submit, description='submit OTP ("אישור")', timeout_ms=20000)
+    # Logged in once the browser has committed a page outside the APM login/logout endpoints.
+    # Clicked once: still on my.policy means the code was rejected, and resubmitting it won't help.
+    try:
+        robust_click(
+            page,
+            locator=submit,
+            description='submit OTP ("אישור")',
+            timeout_ms=20000,
+            expect=PostCondition.url(lambda url: not LOGGED_OUT_URL_REGEX.search(url)),
+            retries=1,
+        )
+    except ClickError as e:
+        if e.kind == "postcondition" and LOGGED_OUT_URL_REGEX.search(page.url or ""):
+            raise RuntimeError(f"OTP was rejected (still on {page.url})") from e
+        raise
+
+
+def login_site(
+    page,
+    site: Dict[str, Any],
+    checkpoint: "Optional[Future[datetime]]" = None,
+    preflight: "Optional[Future[None]]" = None,
+) -> None:
+    with budget_step("login"):
+        log.info(f"[Start] Navigating to {site['login_url']}")
+        page.goto(site["login_url"], wait_until="domcontentloaded", timeout=budget_ms(30000))
+
+        # Checkpoint must predate the submit, otherwise a fast SMS is mistaken for an old one
+        if checkpoint is None and not HAR_REPLAY:
+            checkpoint = BACKGROUND_POOL.submit(take_otp_checkpoint)
+
+        click_reconnect_link_if_present(page)
+        fill_login_credentials(page, site["username"], site["password"])
+        checkpoint_dt = resolve_otp_checkpoint(checkpoint)
+
+        # Don't burn an SMS if Pulseem can't be read (raises the preflight error)
+        if preflight is not None:
+            preflight.result()
+
+        receiver = None if HAR_REPLAY else get_otp_webhook_receiver()
+        if receiver is not None:
+            receiver.arm()
+
+        submitted_at = time.time()
+        click_submit_button(page, site["selectors"].get("otp_input") or "")
+
+    with budget_step("otp"):
+        maybe_handle_otp(
+            page,
+            site["selectors"],
+            checkpoint_dt=checkpoint_dt,
+            submitted_at=submitted_at,
+            har_otp_file=har_path_for(site, HAR_PATH) + ".otp" if HAR_PATH else "",
+        )
+
+
+# ----------------------------
+# Session store (skip login + OTP on warm runs)
+# ----------------------------
+def _site_slug(site: Dict[str, Any]) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", site["name"]).strip("_").lower() or "site"
+
+
+def session_state_path(site: Dict[str, Any]) -> Path:
+    return state_dir("sessions") / f"{_site_slug(site)}.json"
+
+
+def discard_session_state(site: Dict[str, Any]) -> None:
+    try:
+        session_state_path(site).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def load_session_state(site: Dict[str, Any]) -> Optional[Path]:
+    """
+    Return the saved Playwright storage_state for this site, if reuse is enabled and it is not too old.
+    """
+    if not REUSE_SESSIONS:
+        return None
+
+    path = session_state_path(site)
+    if not path.exists():
+        return None
+
+    age = time.time() - path.stat().st_mtime
+    if age > SESSION_MAX_AGE_SECONDS:
+        log.info(f"[Session] Saved session is {int(age)}s old (max {SESSION_MAX_AGE_SECONDS}s), discarding.")
+        discard_session_state(site)
+        return None
+    return path
+
+
+def save_session_state(context, site: Dict[str, Any]) -> None:
+    if not REUSE_SESSIONS:
+        return
+    path = session_state_path(site)
+    try:
+        context.storage_state(path=str(path))
+        log.info(f"[Session] Saved session state: {path}")
+    except Exception as e:
+        log.warning(f"[Session] Could not save session state: {e}")
+
+
+def ensure_site_session(
+    page,
+    site: Dict[str, Any],
+    saved_state: Optional[Path],
+    checkpoint: "Optional[Future[datetime]]" = None,
+    preflight: "Optional[Future[None]]" = None,
+) -> bool:
+    """
+    Leave `page` logged in, via open_report_or_portal: True = on the report, False = on MAIN_PORTAL_URL.
+    A saved session is validated by that same load (one page load when the portal still accepts it),
+    otherwise the full login + OTP runs. Saves the resulting storage_state.
+    """
+    resumed = on_report = False
+    if saved_state:
+        log.info(f"[Session] Trying saved session: {saved_state}")
+        with budget_step("portal"):
+            try:
+                on_report = open_report_or_portal(page, portal_timeout_ms=SESSION_VALIDATE_TIMEOUT_MS)
+                resumed = True
+            except BudgetExhausted:
+                raise
+            except Exception as e:
+                log.info(f"[Session] Saved session rejected: {e}")
+        if resumed:
+            log.info("[Session] Saved session is still valid ✅ (skipping login + OTP)")
+        else:
+            discard_session_state(site)
+            page.context.clear_cookies()
+
+    if not resumed:
+        login_site(page, site, checkpoint=checkpoint, preflight=preflight)
+        with budget_step("portal"):
+            on_report = open_report_or_portal(page)
+
+    save_session_state(page.context, site)
+    return on_report
+
+
+def probe_session_http(state_path: Path) -> Optional[bool]:
+    """
+    Replay the saved cookies against MAIN_PORTAL_URL with plain requests (no browser).
+    Returns True (valid), False (expired: logout/login redirect) or None (could not tell).
+    """
+    try:
+        state = json.loads(state_path.read_text(encoding="utf-8"))
+    except Exception as e:
+        log.warning(f"[Session] Could not read saved session {state_path}: {e}")
+        return None
+
+    started = time.time()
+    s = requests.Session()
+    s.headers["User-Agent"] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome"
+    for c in state.get("cookies", []) or []:
+        s.cookies.set(c.get("name", ""), c.get("value", ""), domain=c.get("domain", ""), path=c.get("path", "/"))
+
+    url = MAIN_PORTAL_URL
+    try:
+        for _ in range(5):
+            r = s.get(url, allow_redirects=False, timeout=SESSION_PROBE_TIMEOUT_SECONDS)
+            if not r.is_redirect:
+                break
+            url = urljoin(url, r.headers.get("Location", ""))
+            if LOGGED_OUT_URL_REGEX.search(url):
+                log.info(f"[Session] HTTP probe: expired (redirect to {url}) in {time.time() - started:.2f}s")
+                return False
+    except requests.RequestException as e:
+        log.warning(f"[Session] HTTP probe failed, will validate in browser: {e}")
+        return None
+    finally:
+        s.close()
+
+    if r.status_code in (401, 403):
+        log.info(f"[Session] HTTP probe: expired (HTTP {r.status_code}) in {time.time() - started:.2f}s")
+        return False
+    if r.status_code == 200:
+        log.info(f"[Session] HTTP probe: valid in {time.time() - started:.2f}s")
+        return True
+
+    log.info(f"[Session] HTTP probe: inconclusive (HTTP {r.status_code})")
+    return None
 
 
 # ----------------------------
@@ -751,10 +2976,417 @@ SITES: List[Dict[str, Any]] = [
 ]
 
 
+# ----------------------------
+# Browser profile (persistent HTTP cache, --reset-profile)
+# ----------------------------
+# Cache folders Chromium rebuilds on its own; everything else (prefs, cookies DB) is kept
+PROFILE_CACHE_DIRS = ("Cache", "Code Cache", "GPUCache", os.path.join("Service Worker", "CacheStorage"))
+
+
+def profile_root() -> Path:
+    return Path(BROWSER_PROFILE_DIR) if BROWSER_PROFILE_DIR else state_dir("profile")
+
+
+def _dir_size(path: Path) -> int:
+    total = 0
+    for dirpath, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, f))
+            except OSError:
+                pass
+    return total
+
+
+def enforce_profile_size(profile: Path) -> None:
+    """
+    Chromium already evicts within --disk-cache-size; this catches the rest (code cache, service workers).
+    Over BROWSER_PROFILE_MAX_MB -> drop the cache folders, largest first, until under the limit.
+    """
+    limit = BROWSER_PROFILE_MAX_MB * 1024 * 1024
+    size = _dir_size(profile)
+    if size <= limit:
+        return
+    caches = [d for name in PROFILE_CACHE_DIRS for d in (profile / "Default" / name, profile / name) if d.is_dir()]
+    for d in sorted(caches, key=_dir_size, reverse=True):
+        freed = _dir_size(d)
+        shutil.rmtree(d, ignore_errors=True)
+        size -= freed
+        log.info(f"[Profile] Evicted {d.name} ({freed / 1048576:.0f} MiB)")
+        if size <= limit:
+            break
+
+
+def reset_browser_profile() -> None:
+    root = profile_root()
+    shutil.rmtree(root, ignore_errors=True)
+    log.info(f"[Profile] Removed browser profile(s): {root}")
+
+
+def launch_site_profile(pw, site: Dict[str, Any], saved_state: Optional[Path]):
+    """
+    Persistent context for `site`. Saved cookies are added explicitly
+    (session cookies don't survive a browser restart).
+    """
+    profile = profile_root() / _site_slug(site)
+    profile.mkdir(parents=True, exist_ok=True)
+    enforce_profile_size(profile)
+    args = [f"--disk-cache-size={BROWSER_PROFILE_MAX_MB * 1024 * 1024 // 2}"] + blocking_launch_args()
+    context = pw.chromium.launch_persistent_context(
+        str(profile),
+        headless=PLAYWRIGHT_HEADLESS,
+        accept_downloads=True,
+        args=args,
+    )
+    context.clear_cookies()  # same starting point as a fresh context: only the saved session, if any
+    if saved_state:
+        try:
+            context.add_cookies(json.loads(saved_state.read_text(encoding="utf-8")).get("cookies") or [])
+        except Exception as e:
+            log.warning(f"[Profile] Could not restore saved cookies: {e}")
+    log.info(f"[Profile] Using browser profile: {profile}")
+    return context
+
+
+CACHE_STATS: Dict[str, int] = {"responses": 0, "hits": 0, "disk": 0}
+
+
+def _track_page_cache(context, page) -> None:
+    try:
+        cdp = context.new_cdp_session(page)
+        cdp.send("Network.enable")
+    except Exception as e:
+        log.info(f"[Cache] CDP not available for cache stats: {e}")
+        return
+
+    served_from_cache = set()  # requestIds Chromium reported as cache hits (memory or disk)
+
+    def _on_served_from_cache(params: Dict[str, Any]) -> None:
+        served_from_cache.add(params.get("requestId"))
+
+    def _on_response(params: Dict[str, Any]) -> None:
+        CACHE_STATS["responses"] += 1
+        from_disk = bool((params.get("response") or {}).get("fromDiskCache"))
+        if from_disk:
+            CACHE_STATS["disk"] += 1
+        if from_disk or params.get("requestId") in served_from_cache:
+            CACHE_STATS["hits"] += 1
+        served_from_cache.discard(params.get("requestId"))
+
+    cdp.on("Network.responseReceived", _on_response)
+    cdp.on("Network.requestServedFromCache", _on_served_from_cache)
+
+
+def install_cache_stats(context) -> None:
+    """Count disk/memory cache hits per response over CDP (Chromium only)."""
+    for pg in context.pages:
+        _track_page_cache(context, pg)
+    context.on("page", lambda pg: _track_page_cache(context, pg))
+
+
+def log_cache_stats() -> None:
+    st = CACHE_STATS
+    if not st["responses"]:
+        return
+    log.info(
+        f"[Cache] hit ratio {100.0 * st['hits'] / st['responses']:.0f}% "
+        f"({st['hits']}/{st['responses']} responses, disk={st['disk']})"
+    )
+
+
+# ----------------------------
+# Keep-alive daemon (--keepalive)
+# ----------------------------
+class KeepAliveScheduler:
+    """
+    Touch interval = learned idle timeout * KEEPALIVE_SAFETY_RATIO.
+    The idle timeout starts at PORTAL_IDLE_TIMEOUT_SECONDS. A single death is not evidence of a shorter
+    idle timeout (sessions also hit an absolute lifetime), so it only shrinks when two touches in a row
+    find the session dead. After KEEPALIVE_GROW_AFTER_TOUCHES healthy touches it probes upward again.
+    """
+
+    STATE_FILE = "keepalive.json"
+
+    def __init__(self) -> None:
+        st = load_json_state(self.STATE_FILE, {})
+        self.idle_timeout = float(st.get("idle_timeout_seconds") or PORTAL_IDLE_TIMEOUT_SECONDS)
+        self.healthy_touches = int(st.get("healthy_touches") or 0)
+        self.dead_last_touch: set = set()  # site names whose previous touch found the session dead
+
+    def interval(self) -> float:
+        return max(float(KEEPALIVE_MIN_INTERVAL_SECONDS), self.idle_timeout * KEEPALIVE_SAFETY_RATIO)
+
+    def record(self, gap_seconds: float, alive: bool, site_name: str = "") -> None:
+        if alive:
+            self.dead_last_touch.discard(site_name)
+            self.healthy_touches += 1
+            if gap_seconds > self.idle_timeout:
+                self.idle_timeout = gap_seconds
+                self.healthy_touches = 0
+            elif (
+                self.healthy_touches >= KEEPALIVE_GROW_AFTER_TOUCHES
+                and self.idle_timeout < PORTAL_IDLE_TIMEOUT_SECONDS
+            ):
+                self.idle_timeout = min(float(PORTAL_IDLE_TIMEOUT_SECONDS), self.idle_timeout * KEEPALIVE_GROW_FACTOR)
+                self.healthy_touches = 0
+                log.info(f"[KeepAlive] Probing a longer idle timeout, next interval {int(self.interval())}s")
+        else:
+            self.healthy_touches = 0
+            if site_name in self.dead_last_touch and gap_seconds < self.idle_timeout:
+                self.idle_timeout = max(float(KEEPALIVE_MIN_INTERVAL_SECONDS), gap_seconds)
+                log.info(
+                    f"[KeepAlive] Session died twice after <= {int(gap_seconds)}s idle, "
+                    f"next interval {int(self.interval())}s"
+                )
+            else:
+                log.info(f"[KeepAlive] Session died after {int(gap_seconds)}s idle, keeping interval {int(self.interval())}s")
+            self.dead_last_touch.add(site_name)
+        save_json_state(
+            self.STATE_FILE,
+            {"idle_timeout_seconds": self.idle_timeout, "healthy_touches": self.healthy_touches},
+        )
+
+
+class LiveSession:
+    """
+    One authenticated context per site, held open by the keep-alive daemon.
+    """
+
+    def __init__(self, browser, site: Dict[str, Any]) -> None:
+        self.browser = browser
+        self.site = site
+        self.context = None
+        self.page = None
+        self.last_touch = 0.0
+        self.on_report = False
+
+    def ensure(self) -> None:
+        if self.context is not None:
+            return
+        saved_state = load_session_state(self.site)
+        self.context = self.browser.new_context(
+            accept_downloads=True,
+            storage_state=str(saved_state) if saved_state else None,
+        )
+        install_request_tracking(self.context)
+        install_overlay_autodismiss(self.context)
+        install_resource_blocking(self.context)
+        self.page = self.context.new_page()
+        try:
+            self.on_report = ensure_site_session(self.page, self.site, saved_state)
+        except Exception:
+            self.close()  # no half-logged-in context: the next ensure() starts over
+            raise
+        self.last_touch = time.time()
+
+    def close(self) -> None:
+        if self.context is not None:
+            try:
+                self.context.close()
+            except Exception:
+                pass
+        self.context = None
+        self.page = None
+
+    def relogin(self) -> None:
+        self.close()
+        discard_session_state(self.site)
+        self.ensure()
+
+    def touch(self, scheduler: KeepAliveScheduler) -> None:
+        """
+        Cheap keep-alive: an APIRequest with the context cookies (no rendering).
+        After a failed login there is no context: log in again instead.
+        """
+        if self.context is None:
+            log.info(f"[KeepAlive] {self.site['name']}: no live session, logging in again")
+            self.ensure()
+            return
+        gap = time.time() - self.last_touch
+        try:
+            resp = self.context.request.get(MAIN_PORTAL_URL, timeout=SESSION_VALIDATE_TIMEOUT_MS)
+            alive = resp.ok and not LOGGED_OUT_URL_REGEX.search(resp.url or "")
+            resp.dispose()
+        except Exception as e:
+            log.warning(f"[KeepAlive] Touch failed (network?), will retry: {e}")
+            return
+
+        scheduler.record(gap, alive, self.site["name"])
+        if alive:
+            self.last_touch = time.time()
+            save_session_state(self.context, self.site)
+            log.info(f"[KeepAlive] {self.site['name']}: session alive (idle {int(gap)}s)")
+        else:
+            log.warning(f"[KeepAlive] {self.site['name']}: session expired, logging in again")
+            self.relogin()
+
+    def run_report(self) -> Path:
+        fresh = self.context is None
+        self.ensure()
+        download_dir = ensure_today_dir(BASE_DOWNLOAD_DIR)
+        try:
+            with RunBudget(KEEPALIVE_RUN_TIMEOUT_SECONDS).activate():
+                if not fresh:
+                    # the page may have sat idle for hours: reload where the flow goes next
+                    try:
+                        with budget_step("portal"):
+                            self.on_report = open_report_or_portal(self.page)
+                    except BudgetExhausted:
+                        raise
+                    except Exception as e:
+                        log.warning(f"[KeepAlive] Live session rejected before report ({e}), logging in again")
+                        self.relogin()
+                run_payments_assembly_flow(
+                    self.page, download_dir, portal_ready=not self.on_report, report_ready=self.on_report
+                )
+        finally:
+            self.last_touch = time.time()
+            for extra in list(self.context.pages):
+                if extra is not self.page:
+                    try:
+                        extra.close()
+                    except Exception:
+                        pass
+        return download_dir
+
+
+@dataclass
+class KeepAliveJob:
+    done: threading.Event = field(default_factory=threading.Event)
+    ok: bool = False
+    result: Dict[str, Any] = field(default_factory=dict)
+
+
+def run_keepalive_daemon() -> None:
+    jobs: "queue.Queue[KeepAliveJob]" = queue.Queue()
+    last_result: Dict[str, Any] = {}
+
+    def _run_route(method: str, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        if method != "POST":
+            return 405, {"error": "POST /run to trigger a report run"}
+        job = KeepAliveJob()
+        jobs.put(job)
+        if not job.done.wait(KEEPALIVE_RUN_TIMEOUT_SECONDS):
+            return 202, {"status": "running"}
+        return (200 if job.ok else 500), job.result
+
+    def _status_route(method: str, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        return 200, {"status": "alive", "interval_seconds": scheduler.interval(), "last_run": last_result}
+
+    preflight_check_pulseem_or_die(PULSEEM_VIRTUAL_NUMBER)
+    scheduler = KeepAliveScheduler()
+    server = start_local_http_server(
+        KEEPALIVE_HOST, KEEPALIVE_PORT, {"/run": _run_route, "/status": _status_route}, name="KeepAlive"
+    )
+
+    def _keep(ls: LiveSession, action: Callable[[], None]) -> None:
+        # One site failing to log in (OTP timeout, portal down) must not stop the daemon:
+        # its context stays reset, the next touch or /run logs in again
+        try:
+            action()
+        except Exception as e:
+            ls.last_touch = time.time()
+            log.exception(
+                f"[KeepAlive] {ls.site['name']}: keep-alive failed, retrying in {int(scheduler.interval())}s: {e}"
+            )
+
+    with sync_playwright() as p:
+        browser = p.chromium.launch(headless=PLAYWRIGHT_HEADLESS, args=blocking_launch_args())
+        sessions = [LiveSession(browser, site) for site in SITES]
+        try:
+            for ls in sessions:
+                _keep(ls, ls.ensure)
+            log.info(f"[KeepAlive] Holding {len(sessions)} session(s), touch every {int(scheduler.interval())}s")
+
+            while True:
+                next_due = min(ls.last_touch for ls in sessions) + scheduler.interval()
+                try:
+                    job: Optional[KeepAliveJob] = jobs.get(timeout=max(1.0, next_due - time.time()))
+                except queue.Empty:
+                    job = None
+
+                if job is not None:
+                    started = time.time()
+                    errors: List[str] = []
+                    for ls in sessions:
+                        try:
+                            ls.run_report()
+                            log.info(f"✓ {ls.site['name']} completed successfully!")
+                        except Exception as e:
+                            log.exception(f"✗ {ls.site['name']} FAILED: {e}")
+                            errors.append(f"{ls.site['name']}: {e}")
+                    job.ok = not errors
+                    job.result = {"ok": job.ok, "errors": errors, "seconds": round(time.time() - started, 1)}
+                    last_result.clear()
+                    last_result.update(job.result, finished_at=datetime.now().isoformat())
+                    job.done.set()
+                    log_pulseem_connection_stats()
+                    log_network_stats()
+                    log_click_stats()
+                    save_latency_history()
+                    continue
+
+                for ls in sessions:
+                    if time.time() - ls.last_touch >= scheduler.interval():
+                        _keep(ls, lambda: ls.touch(scheduler))
+        except KeyboardInterrupt:
+            log.info("[KeepAlive] Stopping...")
+        finally:
+            for ls in sessions:
+                ls.close()
+            browser.close()
+            server.shutdown()
+
+
+def trigger_keepalive_run() -> Optional[bool]:
+    """
+    Ask a running --keepalive daemon to run the report. None = no daemon listening.
+    """
+    url = f"http://{KEEPALIVE_HOST}:{KEEPALIVE_PORT}/run"
+    try:
+        r = requests.post(url, timeout=KEEPALIVE_RUN_TIMEOUT_SECONDS + 10)
+    except requests.ConnectionError:
+        return None
+    payload = r.json() if r.content else {}
+    log.info(f"[KeepAlive] Daemon replied HTTP {r.status_code}: {payload}")
+    return r.status_code in (200, 202)
+
+
 # ----------------------------
 # Main
 # ----------------------------
-def main() -> None:
+def configure_har_mode(record_har: Optional[str], replay_har: Optional[str]) -> None:
+    """
+    Both modes drive the full UI flow (login + OTP, Favorites, paid.aspx clicks) so the archive
+    covers every request: no session reuse, deep link, export replay or persistent profile.
+    Replay also keeps its learned state (latencies, strategies, sessions) and the replayed Excel
+    out of the live BOT_STATE_DIR / BASE_DOWNLOAD_DIR.
+    """
+    global HAR_PATH, HAR_REPLAY, REUSE_SESSIONS, REPORT_DEEP_LINK, EXPORT_REPLAY, BROWSER_PROFILE
+    global BOT_STATE_DIR, BASE_DOWNLOAD_DIR
+    if not record_har and not replay_har:
+        return
+    HAR_PATH = record_har or replay_har or ""
+    REUSE_SESSIONS = REPORT_DEEP_LINK = EXPORT_REPLAY = BROWSER_PROFILE = False
+    if replay_har:
+        HAR_REPLAY = True
+        BOT_STATE_DIR = str(Path(BOT_STATE_DIR) / "har_replay")
+        BASE_DOWNLOAD_DIR = str(Path(BOT_STATE_DIR) / "downloads")
+        log.info(f"[HAR] Replaying portal traffic from {replay_har} (OTP short-circuited, no Pulseem)")
+    else:
+        Path(record_har).parent.mkdir(parents=True, exist_ok=True)
+        log.info(f"[HAR] Recording portal traffic to {record_har} (contains the login password and session cookies)")
+
+
+def har_path_for(site: Dict[str, Any], har_path: str) -> str:
+    """One archive per site; the given path as-is when there is only one."""
+    if len(SITES) == 1:
+        return har_path
+    p = Path(har_path)
+    return str(p.with_name(f"{p.stem}_{_site_slug(site)}{p.suffix}"))
+
+
+def run_once(record_har: Optional[str] = None, replay_har: Optional[str] = None) -> None:
     download_dir = ensure_today_dir(BASE_DOWNLOAD_DIR)
 
     log.info("=" * 60)
@@ -766,29 +3398,60 @@ def main() -> None:
     log.info(f"Main portal URL: {MAIN_PORTAL_URL}")
     log.info("=" * 60)
 
-    preflight_check_pulseem_or_die(PULSEEM_VIRTUAL_NUMBER)
+    # Off the critical path: runs while Chromium launches and the login page loads,
+    # and is only awaited right before the login submit (no Pulseem at all when replaying a HAR)
+    preflight: Optional[Future] = None
+    if not replay_har:
+        preflight = BACKGROUND_POOL.submit(preflight_check_pulseem_or_die, PULSEEM_VIRTUAL_NUMBER)
+
+    # Decide reuse vs. login before any browser is spawned
+    saved_states: Dict[str, Optional[Path]] = {}
+    for site in SITES:
+        saved = load_session_state(site)
+        if saved and probe_session_http(saved) is False:
+            discard_session_state(site)
+            saved = None
+        saved_states[site["name"]] = saved
+
+    # A login is certain -> take the Pulseem checkpoint while Chromium starts
+    otp_checkpoint: Optional[Future] = None
+    if not replay_har and any(v is None for v in saved_states.values()):
+        otp_checkpoint = BACKGROUND_POOL.submit(take_otp_checkpoint)
 
     with sync_playwright() as p:
-        browser = p.chromium.launch(headless=PLAYWRIGHT_HEADLESS)
-        context = browser.new_context(accept_downloads=True)
+        launch_args = [] if replay_har else blocking_launch_args()
+        browser = None if BROWSER_PROFILE else p.chromium.launch(headless=PLAYWRIGHT_HEADLESS, args=launch_args)
 
         for site in SITES:
             log.info("\n" + "=" * 60)
             log.info(f"Processing: {site['name']}")
             log.info("=" * 60)
 
+            saved_state = saved_states.get(site["name"])
+            if BROWSER_PROFILE:
+                context = launch_site_profile(p, site, saved_state)
+                install_cache_stats(context)
+                install_resource_blocking(context)
+            else:
+                context = browser.new_context(
+                    accept_downloads=True,
+                    storage_state=str(saved_state) if saved_state else None,
+                    record_har_path=har_path_for(site, record_har) if record_har else None,
+                )
+                if replay_har:
+                    # anything the archive doesn't have fails fast instead of reaching the live portal
+                    context.route_from_har(har_path_for(site, replay_har), not_found="abort")
+                else:
+                    install_resource_blocking(context)
+            install_request_tracking(context)
+            install_overlay_autodismiss(context)
             page = context.new_page()
             try:
-                log.info(f"[Start] Navigating to {site['login_url']}")
-                page.goto(site["login_url"], wait_until="domcontentloaded")
-                wait_page_ready(page)
-
-                click_reconnect_link_if_present(page)
-                fill_login_credentials(page, site["username"], site["password"])
-                click_submit_button(page)
-                maybe_handle_otp(page, site["selectors"])
-
-                run_payments_assembly_flow(page, download_dir)
+                # The pre-started checkpoint is only valid for the first login of this run
+                checkpoint, otp_checkpoint = otp_checkpoint, None
+                with RunBudget(RUN_BUDGET_SECONDS).activate():
+                    on_report = ensure_site_session(page, site, saved_state, checkpoint=checkpoint, preflight=preflight)
+                    run_payments_assembly_flow(page, download_dir, portal_ready=not on_report, report_ready=on_report)
                 log.info(f"✓ {site['name']} completed successfully!")
 
             except Exception as e:
@@ -805,14 +3468,72 @@ def main() -> None:
                     page.close()
                 except Exception:
                     pass
+                try:
+                    context.close()  # also writes the HAR when recording
+                except Exception:
+                    pass
 
-        context.close()
-        browser.close()
+        if browser is not None:
+            browser.close()
+
+    if preflight is not None and preflight.done() and preflight.exception() is not None:
+        log.warning(f"[Preflight] Pulseem check failed this run: {preflight.exception()}")
+
+    log_pulseem_connection_stats()
+    log_network_stats()
+    log_cache_stats()
+    log_click_stats()
+    save_latency_history()
+    if OVERLAY_STATS["dismissed"]:
+        log.info(f"[Overlay] Auto-dismissed {OVERLAY_STATS['dismissed']} dialog(s) this run")
 
     log.info("\n" + "=" * 60)
     log.info("Bot execution completed")
     log.info("=" * 60)
 
 
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Harel Agents payments report bot")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--keepalive", action="store_true", help="hold the portal session open and serve report runs")
+    mode.add_argument("--trigger", action="store_true", help="run the report through a running --keepalive daemon")
+    mode.add_argument("--fake-sms", metavar="TEXT", help="POST a fake inbound SMS to the local OTP webhook (testing)")
+    mode.add_argument("--reset-profile", action="store_true", help="delete the persistent browser profile(s) and exit")
+    har = parser.add_mutually_exclusive_group()
+    har.add_argument("--record-har", metavar="PATH", help="record the portal traffic of a full run to a HAR archive")
+    har.add_argument("--replay-har", metavar="PATH", help="run offline against a recorded HAR (OTP short-circuited)")
+    args = parser.parse_args(argv)
+    if (args.record_har or args.replay_har) and (args.keepalive or args.trigger):
+        parser.error("--record-har/--replay-har only apply to a normal run")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+
+    if args.fake_sms:
+        send_fake_sms(args.fake_sms)
+        return
+
+    if args.reset_profile:
+        reset_browser_profile()
+        return
+
+    if args.keepalive:
+        run_keepalive_daemon()
+        return
+
+    if args.trigger:
+        ok = trigger_keepalive_run()
+        if ok is not None:
+            if not ok:
+                sys.exit(1)
+            return
+        log.info("[KeepAlive] No daemon listening, running a normal (cold) run.")
+
+    configure_har_mode(args.record_har, args.replay_har)
+    run_once(record_har=args.record_har, replay_har=args.replay_har)
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()